@@ -1,9 +1,18 @@
-from flask import Flask, jsonify, request
+import os
+import threading
+from functools import wraps
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
-import psycopg2
 from psycopg2.extras import RealDictCursor
-import os
 from dotenv import load_dotenv
+from db import get_pool, PoolTimeout
+from derived_tables import pick_geometry_lod
+from cache import VARIANT_ENCODINGS, compress_variants, variant_etag
+from geo_index import locate_results, read_points
+import queries
+import service
+from queries import run_sync
+from service import response_cache, tile_cache, topology_cache, CACHE_CONTROL, LOCATE_MAX_POINTS
 
 load_dotenv()
 
@@ -11,386 +20,300 @@ app = Flask(__name__)
 app.json.ensure_ascii = False
 CORS(app)
 
+# Verrous des états partagés de service.py (version des données, index de localisation)
+_data_version_lock = threading.Lock()
+_zone_locator_lock = threading.Lock()
+
 def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.getenv('DB_HOST'),
-        database=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        port=os.getenv('DB_PORT'),
-        client_encoding='utf8'
-    )
-    conn.set_client_encoding('UTF8')
-    return conn
+    """Emprunte une connexion au pool partagé (à rendre avec release_db_connection)."""
+    return get_pool().getconn()
+
+def release_db_connection(conn):
+    get_pool().putconn(conn)
+
+def fetch(plan):
+    """Exécute une requête de queries.py sur une connexion empruntée au pool"""
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    try:
+        return run_sync(cur, plan)
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    app.logger.warning(f"Pool de connexions saturé : {e}")
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+def current_data_version():
+    """Version courante des données ; les caches sont vidés quand seed/ingest la changent"""
+    with _data_version_lock:
+        if service.data_version.fresh():
+            return service.data_version.value
+        return service.data_version.update(fetch(queries.data_version()))
+
+def request_keys(version):
+    """(clé de cache, ETag) de la requête courante"""
+    return service.request_keys(version, request.path, request.args.items(multi=True))
+
+def accepts_encoding(encoding):
+    return bool(request.accept_encodings[encoding])
+
+def matching_etag(etag, variants):
+    """ETag de la représentation négociée si le client la possède déjà (If-None-Match), sinon None"""
+    negotiated = service.negotiated_etag(etag, variants, accepts_encoding)
+    return negotiated if request.if_none_match.contains_weak(negotiated) else None
+
+def not_modified(etag, cache_control=None):
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    if cache_control: response.headers['Cache-Control'] = cache_control
+    return response
+
+def variants_response(variants, mimetype, etag, cache_control=None):
+    """Réponse dans l'encodage négocié, à partir des versions précompressées"""
+    encoding = service.negotiate_encoding(variants, accepts_encoding)
+    response = Response(variants[encoding], mimetype=mimetype)
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if cache_control: response.headers['Cache-Control'] = cache_control
+    response.set_etag(variant_etag(etag, encoding))
+    return response
+
+def cached_response(cache_control=None):
+    """Réponses 304 sur If-None-Match et cache du corps encodé (et compressé) des réponses 200.
+
+    `cache_control` est celui de la route : envoyé avec chaque 200 et chaque 304, que la
+    réponse soit encore en cache ou non.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            version = current_data_version()
+            key, etag = request_keys(version)
+            entry = response_cache.get(key)
+            client_etag = matching_etag(etag, entry[0] if entry else VARIANT_ENCODINGS)
+            if client_etag:
+                return not_modified(client_etag, cache_control)
+            if entry is not None:
+                variants, mimetype = entry
+                response = variants_response(variants, mimetype, etag, cache_control)
+                response.headers['X-Cache'] = 'HIT'
+                return response
+
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough:
+                variants, size = compress_variants(response.get_data())
+                response_cache.set(key, (variants, response.mimetype), size=size)
+                response = variants_response(variants, response.mimetype, etag, cache_control)
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+def geometry_lod_from_request():
+    """(lod, décimales) demandés via ?zoom= ou ?tolerance= ; ValueError si invalide"""
+    return service.geometry_lod(request.args.get('zoom'), request.args.get('tolerance'))
+
+def viewport_from_request():
+    """(bbox, clip) demandés via ?bbox= et ?clip= ; ValueError si bbox invalide"""
+    return service.viewport(request.args.get('bbox'), request.args.get('clip'))
+
+def zone_topology(cur, version, level, parent_id, lod, decimals, bbox=None, clip=False):
+    """Topologie TopoJSON des zones d'un niveau (service.topology_cache).
+
+    `version` est lue par la vue avant d'emprunter `cur` : relire la version ici
+    emprunterait une seconde connexion au pool pendant que la première est tenue.
+    """
+    key = service.topology_key(version, level, parent_id, lod, bbox, clip)
+    topology = topology_cache.get(key)
+    if topology is None:
+        features = run_sync(cur, queries.zone_features(level, parent_id, lod, decimals, bbox, clip))
+        topology = service.cache_topology(key, features)
+    return topology
+
+def zone_locator():
+    """STRtree des contours des zones, chargé au premier appel puis à chaque nouvelle version des données"""
+    version = current_data_version()
+    with _zone_locator_lock:
+        index = service.zone_locator.get(version)
+        if index is None:
+            index = service.zone_locator.build(version, fetch(queries.zone_geometries()))
+        return index
+
+def warm_zone_locator():
+    """Charge l'index de localisation au démarrage (sinon à la première requête /api/gis/locate)"""
+    try:
+        zone_locator()
+    except Exception as e:
+        app.logger.warning(f"Index de localisation non chargé au démarrage : {e}")
+
+# Chargé en arrière-plan dès l'import de l'application, donc au démarrage de chaque worker
+# gunicorn ; une requête /api/gis/locate arrivée avant la fin attend ce chargement (verrou).
+if os.getenv('LOCATE_WARMUP', '1') == '1':
+    threading.Thread(target=warm_zone_locator, name='zone-locator-warmup', daemon=True).start()
 
 # ... [Les routes existantes get_zones, get_filters, get_map_data restent identiques] ...
 # Je remets get_zones et get_filters pour la complétude, suivi des nouvelles routes.
+# Le SQL des routes de lecture est dans queries.py, partagé avec asgi_app.py.
 
 @app.route('/api/gis/zones', methods=['GET'])
+@cached_response()
 def get_zones():
     level = request.args.get('level', 'REGION').upper()
-    parent_id = request.args.get('parent_id')
+    try:
+        parent_id = service.parent_zone(request.args.get('parent_id'))
+        bbox, clip = viewport_from_request()
+        lod, decimals = geometry_lod_from_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    version = current_data_version()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        query = "SELECT id, name, level, parent_id, code, ST_AsGeoJSON(geometry)::json as geometry FROM administrative_zones WHERE level = %s"
-        params = [level]
-        if parent_id and parent_id != 'null' and parent_id != 'undefined':
-            query += " AND parent_id = %s"
-            params.append(str(parent_id))
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        features = []
-        for row in rows:
-            features.append({
-                "type": "Feature",
-                "properties": row,
-                "geometry": row['geometry']
-            })
-        return jsonify({"type": "FeatureCollection", "features": features})
+        if request.args.get('format') == 'points':
+            # Sans contours : point d'étiquette, centroïde, emprise et surface précalculés
+            return Response(run_sync(cur, queries.zones_points(level, parent_id, bbox)), mimetype='application/json')
+        if request.args.get('format') == 'topojson':
+            return jsonify(zone_topology(cur, version, level, parent_id, lod, decimals, bbox, clip))
+
+        # La FeatureCollection est sérialisée par PostgreSQL et renvoyée telle quelle
+        collection = run_sync(cur, queries.zones_collection(level, parent_id, lod, decimals, bbox, clip))
+        return Response(collection, mimetype='application/json')
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/filters', methods=['GET'])
+@cached_response()
 def get_filters():
-    parent_id = request.args.get('parent_id')
+    try:
+        parent_id = service.parent_zone(request.args.get('parent_id'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        if not parent_id or parent_id == 'null' or parent_id == 'undefined':
-            where_clause = "1=1"
-            params = []
-        else:
-            where_clause = """
-                ps.zone_code IN (
-                    WITH RECURSIVE zone_tree AS (
-                        SELECT code, id FROM administrative_zones WHERE id = %s
-                        UNION ALL
-                        SELECT az.code, az.id FROM administrative_zones az
-                        JOIN zone_tree zt ON az.parent_id = zt.id::text
-                    )
-                    SELECT code FROM zone_tree
-                )
-            """
-            params = [int(parent_id)]
-        query = f"""
-            SELECT DISTINCT ss.id, ss.name, ss.color, s.name as category
-            FROM sub_sectors ss
-            JOIN sectors s ON ss.sector_id = s.id
-            JOIN production_stats ps ON ps.sub_sector_id = ss.id
-            WHERE {where_clause}
-            ORDER BY s.name, ss.name
-        """
-        cur.execute(query, params)
-        rows = cur.fetchall()
-        grouped = {}
-        for row in rows:
-            cat = row['category']
-            if cat not in grouped: grouped[cat] = []
-            grouped[cat].append(row)
-        return jsonify(grouped)
+        return jsonify(run_sync(cur, queries.filters(parent_id)))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/map/data', methods=['GET'])
+@cached_response(CACHE_CONTROL)
 def get_map_data():
     sub_sector_id = request.args.get('sector_id')
     level = request.args.get('level', 'REGION').upper()
-    parent_id = request.args.get('parent_id')
+    try:
+        parent_id = service.parent_zone(request.args.get('parent_id'))
+        bbox, clip = viewport_from_request()
+        lod, decimals = geometry_lod_from_request()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    version = current_data_version()
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        cur.execute("SELECT ss.name, ss.color, s.name as category FROM sub_sectors ss JOIN sectors s ON ss.sector_id = s.id WHERE ss.id = %s", (sub_sector_id,))
-        sector_info = cur.fetchone()
-
-        zones_query = "SELECT id, name, level, parent_id, code, ST_AsGeoJSON(geometry)::json as geometry FROM administrative_zones WHERE level = %s"
-        zones_params = [level]
-        if parent_id and parent_id != 'null' and parent_id != 'undefined':
-            zones_query += " AND parent_id = %s"
-            zones_params.append(str(parent_id))
-        cur.execute(zones_query, zones_params)
-        zones = cur.fetchall()
-
-        features = []
-        total_global_volume = 0
-        global_unit = ""
-
-        for zone in zones:
-            stats_query = """
-                WITH RECURSIVE zone_descendants AS (
-                    SELECT code, id FROM administrative_zones WHERE id = %s
-                    UNION ALL
-                    SELECT az.code, az.id FROM administrative_zones az
-                    JOIN zone_descendants zd ON az.parent_id = zd.id::text
-                )
-                SELECT SUM(volume) as total, MAX(unit) as unit
-                FROM production_stats
-                WHERE sub_sector_id = %s AND zone_code IN (SELECT code FROM zone_descendants)
-            """
-            cur.execute(stats_query, (zone['id'], sub_sector_id))
-            stat = cur.fetchone()
-            vol = float(stat['total']) if stat and stat['total'] else 0
-            unit = stat['unit'] if stat and stat['unit'] else ""
-            if unit: global_unit = unit
-            total_global_volume += vol
-
-            features.append({
-                "type": "Feature",
-                "properties": {**zone, "value": vol, "unit": unit},
-                "geometry": zone['geometry']
-            })
-
-        response = jsonify({
-            "geojson": { "type": "FeatureCollection", "features": features },
-            "stats": { "total": total_global_volume, "unit": global_unit },
-            "sector": sector_info
-        })
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
+        if request.args.get('format') == 'topojson':
+            # Les contours viennent de la topologie en cache, seules les valeurs sont lues
+            sector_info, values = run_sync(cur, queries.map_values(sub_sector_id, level, parent_id, lod, bbox))
+            topology = zone_topology(cur, version, level, parent_id, lod, decimals, bbox, clip)
+            return jsonify(queries.map_data_topojson(topology, sector_info, values))
+        # Features et totaux sérialisés par PostgreSQL, insérés tels quels dans la réponse
+        body = run_sync(cur, queries.map_data_geojson(sub_sector_id, level, parent_id, lod, decimals, bbox, clip))
+        return Response(body, mimetype='application/json')
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
-@app.route('/api/zone/stats', methods=['GET'])
-def get_zone_stats():
-    zone_id = request.args.get('zone_id')
+# --- SECTIONS DU PANNEAU DROIT (queries.PANEL_SECTIONS) ---
+
+def panel_section_response(section, zone_id, sector_id=None, year=None):
+    """Route individuelle d'une section du panneau ; 400 si zone_id, sector_id ou year sont invalides"""
+    try:
+        zone_id = queries.parse_int('zone_id', zone_id)
+        params = service.panel_params(sector_id, year)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        query = """
-            WITH RECURSIVE zone_tree AS (
-                SELECT code, id FROM administrative_zones WHERE id = %s
-                UNION ALL
-                SELECT az.code, az.id FROM administrative_zones az
-                JOIN zone_tree zt ON az.parent_id = zt.id::text
-            )
-            SELECT ss.name as sector, s.name as category, SUM(ps.volume) as volume, MAX(ps.unit) as unit
-            FROM production_stats ps
-            JOIN sub_sectors ss ON ps.sub_sector_id = ss.id
-            JOIN sectors s ON ss.sector_id = s.id
-            WHERE ps.zone_code IN (SELECT code FROM zone_tree)
-            GROUP BY ss.name, s.name
-            ORDER BY volume DESC
-        """
-        cur.execute(query, (int(zone_id),))
-        rows = cur.fetchall()
-        response = jsonify(rows)
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
+        return jsonify(run_sync(cur, section(zone_id, **params)))
     except Exception as e:
+        app.logger.error(f"Erreur {request.path}: {e}")
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+@app.route('/api/zone/stats', methods=['GET'])
+@cached_response(CACHE_CONTROL)
+def get_zone_stats():
+    return panel_section_response(queries.zone_stats_section, request.args.get('zone_id'))
 
 # --- NOUVELLES ROUTES POUR LE PANNEAU DROIT ---
 
 @app.route('/api/stats/evolution', methods=['GET'])
+@cached_response(CACHE_CONTROL)
 def get_evolution_stats():
     """Evolution temporelle avec métadonnées de catégorie"""
-    zone_id = request.args.get('zone_id')
-    
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        # On récupère aussi s.name (Catégorie)
-        query = """
-            WITH RECURSIVE zone_tree AS (
-                SELECT code, id FROM administrative_zones WHERE id = %s
-                UNION ALL
-                SELECT az.code, az.id FROM administrative_zones az
-                JOIN zone_tree zt ON az.parent_id = zt.id::text
-            )
-            SELECT ps.year, ss.name as sector, s.name as category, SUM(ps.volume) as volume
-            FROM production_stats ps
-            JOIN sub_sectors ss ON ps.sub_sector_id = ss.id
-            JOIN sectors s ON ss.sector_id = s.id -- Jointure ajoutée
-            WHERE ps.zone_code IN (SELECT code FROM zone_tree)
-            GROUP BY ps.year, ss.name, s.name
-            ORDER BY ps.year ASC
-        """
-        cur.execute(query, (int(zone_id),))
-        rows = cur.fetchall()
-
-        data_by_year = {}
-        sectors = set()
-        # Dictionnaire pour mapper Filière -> Catégorie
-        # Ex: {"Cacao": "Agriculture", "Bovins": "Elevage"}
-        categories_map = {} 
-
-        for row in rows:
-            year = int(row['year']) 
-            if year not in data_by_year: data_by_year[year] = {"year": year}
-            
-            sector_name = row['sector']
-            data_by_year[year][sector_name] = float(row['volume'])
-            
-            sectors.add(sector_name)
-            categories_map[sector_name] = row['category'].upper() # On normalise en MAJ
-
-        sorted_data = sorted(list(data_by_year.values()), key=lambda x: x['year'])
-
-        response = jsonify({
-            "data": sorted_data, 
-            "sectors": list(sectors),
-            "categories": categories_map # On renvoie ce mapping au frontend
-        })
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        cur.close()
-        conn.close()
-        
+    return panel_section_response(queries.evolution_section, request.args.get('zone_id'))
+
 @app.route('/api/stats/comparison', methods=['GET'])
+@cached_response(CACHE_CONTROL)
 def get_comparison_stats():
     """Comparaison des enfants directs (ex: Départements d'une Région)"""
-    zone_id = request.args.get('zone_id')
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor)
-    try:
-        # Trouver les enfants directs
-        query = """
-            SELECT id, name, code FROM administrative_zones WHERE parent_id = %s
-        """
-        cur.execute(query, (str(zone_id),))
-        children = cur.fetchall()
-
-        comparison_data = []
-
-        for child in children:
-            # Somme totale de production pour cet enfant (toutes filières confondues - attention aux unités différentes,
-            # idéalement on filtre par filière principale, ici on fait une somme globale brute pour l'exemple ou on prend le top produit)
-
-            # Pour l'exemple, on prend le volume total du produit le plus important de la zone parente
-            # 1. Trouver le top produit de la zone parente
-            cur.execute("""
-                WITH RECURSIVE zone_tree AS (
-                    SELECT code, id FROM administrative_zones WHERE id = %s
-                    UNION ALL
-                    SELECT az.code, az.id FROM administrative_zones az
-                    JOIN zone_tree zt ON az.parent_id = zt.id::text
-                )
-                SELECT sub_sector_id FROM production_stats ps
-                WHERE zone_code IN (SELECT code FROM zone_tree)
-                GROUP BY sub_sector_id ORDER BY SUM(volume) DESC LIMIT 1
-            """, (int(zone_id),))
-            top_sector = cur.fetchone()
-
-            if top_sector:
-                sid = top_sector['sub_sector_id']
-                # 2. Calculer le volume de ce produit pour l'enfant (récursif)
-                cur.execute("""
-                    WITH RECURSIVE child_tree AS (
-                        SELECT code, id FROM administrative_zones WHERE id = %s
-                        UNION ALL
-                        SELECT az.code, az.id FROM administrative_zones az
-                        JOIN child_tree zt ON az.parent_id = zt.id::text
-                    )
-                    SELECT SUM(volume) as total FROM production_stats
-                    WHERE sub_sector_id = %s AND zone_code IN (SELECT code FROM child_tree)
-                """, (child['id'], sid))
-                res = cur.fetchone()
-                vol = float(res['total']) if res and res['total'] else 0
-                comparison_data.append({"name": child['name'], "value": vol})
-
-        response = jsonify(comparison_data)
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
-    finally:
-        cur.close()
-        conn.close()
+    return panel_section_response(
+        queries.comparison_section, request.args.get('zone_id'),
+        sector_id=request.args.get('sector_id'), year=request.args.get('year')
+    )
 
 @app.route('/api/stats/global', methods=['GET'])
+@cached_response(CACHE_CONTROL)
 def get_global_zone_stats():
     """Stats globales d'une zone (Nom, TOUTES les productions, Volume total)"""
-    zone_id = request.args.get('zone_id')
-    year = request.args.get('year') # Si tu gères l'année
-    
-    if not zone_id:
-        return jsonify({"error": "zone_id is required"}), 400
-        
+    return panel_section_response(queries.global_section, request.args.get('zone_id'), year=request.args.get('year'))
+
+@app.route('/api/zone/panel', methods=['GET'])
+@cached_response(CACHE_CONTROL)
+def get_zone_panel():
+    """Toutes les sections du panneau droit pour une ou plusieurs zones, en une requête.
+
+    ?zone_ids=12,15&sections=stats,evolution,comparison,global[&year=2023][&sector_id=3]
+    """
+    try:
+        zone_ids = queries.parse_ids('zone_ids', request.args.get('zone_ids', request.args.get('zone_id')))
+        sections = service.panel_sections(request.args.get('sections'))
+        params = service.panel_params(request.args.get('sector_id'), request.args.get('year'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    # Une seule connexion pour toutes les zones et sections
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # 1. Info Zone
-        cur.execute("SELECT name, level FROM administrative_zones WHERE id = %s", (int(zone_id),))
-        zone_info = cur.fetchone()
-
-        # Construction de la clause WHERE pour l'année
-        year_clause = "AND ps.year = %s" if year else ""
-        params_top = [int(zone_id)]
-        if year: params_top.append(year)
-
-        # 2. TOUTES les productions (On a retiré LIMIT 5)
-        # On a retiré producer_count
-        all_products_query = f"""
-            SELECT ss.name, SUM(ps.volume) as volume, MAX(ps.unit) as unit
-            FROM production_stats ps
-            JOIN sub_sectors ss ON ps.sub_sector_id = ss.id
-            WHERE ps.zone_code IN (
-                 WITH RECURSIVE zone_tree AS (
-                    SELECT code, id FROM administrative_zones WHERE id = %s
-                    UNION ALL
-                    SELECT az.code, az.id FROM administrative_zones az
-                    JOIN zone_tree zt ON az.parent_id = zt.id::text
-                ) SELECT code FROM zone_tree
-            )
-            {year_clause}
-            GROUP BY ss.name
-            ORDER BY volume DESC
-        """
-        cur.execute(all_products_query, params_top)
-        all_products = cur.fetchall()
-
-        # 3. Volume Total uniquement (Plus de producteurs)
-        params_total = [int(zone_id)]
-        if year: params_total.append(year)
-        
-        totals_query = f"""
-            SELECT SUM(ps.volume) as total_volume
-            FROM production_stats ps
-            WHERE ps.zone_code IN (
-                WITH RECURSIVE zone_tree AS (
-                    SELECT code, id FROM administrative_zones WHERE id = %s
-                    UNION ALL
-                    SELECT az.code, az.id FROM administrative_zones az
-                    JOIN zone_tree zt ON az.parent_id = zt.id::text
-                ) SELECT code FROM zone_tree
-            )
-            {year_clause.replace('ps.', '')} -- petite astuce si ps n'est pas aliasé pareil, mais ici ok
-        """
-        cur.execute(totals_query, params_total)
-        totals = cur.fetchone()
-
-        response = jsonify({
-            "zone_name": zone_info['name'] if zone_info else 'N/A',
-            "zone_level": zone_info['level'] if zone_info else 'N/A',
-            "top_products": all_products, # On garde la clé "top_products" pour pas casser le frontend, mais elle contient TOUT
-            "total_volume": float(totals['total_volume']) if totals and totals['total_volume'] else 0
-            # On a retiré total_producers
-        })
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
+        return jsonify(run_sync(cur, queries.zone_panel(zone_ids, sections, **params)))
     except Exception as e:
-        app.logger.error(f"Erreur stats/global: {e}")
+        app.logger.error(f"Erreur zone/panel: {e}")
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 @app.route('/api/gis/search', methods=['GET'])
+@cached_response(CACHE_CONTROL)
 def search_zones():
     query = request.args.get('q', '').strip()
     if len(query) < 2:
@@ -399,26 +322,77 @@ def search_zones():
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=RealDictCursor)
     try:
-        # On cherche dans les noms, insensible à la casse
-        # On exclut le niveau PAYS car inutile à chercher
-        sql = """
-            SELECT id, name, level, parent_id 
-            FROM administrative_zones 
-            WHERE name ILIKE %s AND level != 'COUNTRY'
-            ORDER BY name ASC
-            LIMIT 10
-        """
-        search_pattern = f"%{query}%"
-        cur.execute(sql, (search_pattern,))
-        results = cur.fetchall()
-        response = jsonify(results)
-        response.headers['Cache-Control'] = 'public, max-age=3600'
-        return response
+        return jsonify(run_sync(cur, queries.search(query)))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
         
+@app.route('/api/gis/locate', methods=['GET', 'POST'])
+def locate_points():
+    """Zone la plus profonde contenant chaque point et ses parents (GET ?lat=&lon=, POST JSON ou CSV)"""
+    try:
+        if request.method == 'POST':
+            ids, lats, lons = read_points(request.get_data(), request.mimetype, LOCATE_MAX_POINTS)
+        else:
+            ids, lats, lons = service.query_point(request.args.get('lat'), request.args.get('lon'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        results = locate_results(zone_locator(), ids, lats, lons)
+        if request.method == 'GET':
+            return jsonify(results[0])
+        return jsonify(service.locate_summary(results))
+    except Exception as e:
+        app.logger.error(f"Erreur gis/locate: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/tiles/<layer>/<int:z>/<int:x>/<int:y>.pbf', methods=['GET'])
+def get_tile(layer, z, x, y):
+    """Tuile vectorielle (Mapbox Vector Tile) des zones d'un niveau, avec la valeur de la filière"""
+    level = service.tile_level(layer, z, x, y)
+    if level is None:
+        return jsonify({"error": "Tuile inconnue"}), 404
+    sub_sector_id = service.tile_sector(request.args.get('sector_id'))
+
+    version = current_data_version()
+    _, etag = request_keys(version)
+    cache_key = service.tile_key(version, level, z, x, y, sub_sector_id)
+    variants = tile_cache.get(cache_key)
+    client_etag = matching_etag(etag, variants or VARIANT_ENCODINGS)
+    if client_etag:
+        return not_modified(client_etag, CACHE_CONTROL)
+
+    cache_status = 'HIT'
+    if variants is None:
+        cache_status = 'MISS'
+        conn = get_db_connection()
+        cur = conn.cursor(cursor_factory=RealDictCursor)
+        try:
+            lod, _ = pick_geometry_lod(zoom=z)
+            tile = run_sync(cur, queries.vector_tile(level, z, x, y, lod, sub_sector_id, layer.lower()))
+            variants, size = compress_variants(tile)
+            tile_cache.set(cache_key, variants, size=size)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
+        finally:
+            cur.close()
+            release_db_connection(conn)
+
+    response = variants_response(variants, 'application/vnd.mapbox-vector-tile', etag, CACHE_CONTROL)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+@app.route('/api/health/cache', methods=['GET'])
+def get_cache_stats():
+    return jsonify(service.cache_stats(current_data_version()))
+
+@app.route('/api/health/pool', methods=['GET'])
+def get_pool_stats():
+    """Statistiques du pool de connexions (pour le dimensionner)"""
+    return jsonify(get_pool().stats())
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
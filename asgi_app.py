@@ -0,0 +1,441 @@
+"""Point d'entrée ASGI de l'api : mêmes routes /api/... que app.py, accès base non bloquant.
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port 8000 --workers 2
+
+Les requêtes viennent de queries.py (SQL commun avec app.py), exécutées avec un pool
+psycopg 3 asynchrone ; caches, ETags et validation des paramètres sont dans service.py. Chaque route limite le nombre de requêtes traitées en même temps
+(ASGI_ROUTE_CONCURRENCY) : au-delà, les requêtes attendent au plus ASGI_QUEUE_TIMEOUT
+secondes puis reçoivent un 503, comme quand le pool de app.py est saturé.
+"""
+import os
+import json
+import asyncio
+import decimal
+import datetime
+import logging
+from contextlib import asynccontextmanager
+from functools import wraps
+from dotenv import load_dotenv
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+from derived_tables import pick_geometry_lod
+from cache import VARIANT_ENCODINGS, compress_variants, variant_etag
+from geo_index import locate_results, read_points
+import queries
+import service
+from queries import run_async
+from service import response_cache, tile_cache, topology_cache, CACHE_CONTROL, LOCATE_MAX_POINTS
+
+load_dotenv()
+
+logger = logging.getLogger("asgi_app")
+
+pool = AsyncConnectionPool(
+    conninfo="",
+    min_size=int(os.getenv('DB_POOL_MIN', '1')),
+    max_size=int(os.getenv('DB_POOL_MAX', '10')),
+    timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+    max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+    kwargs={
+        "host": os.getenv('DB_HOST'),
+        "dbname": os.getenv('DB_NAME'),
+        "user": os.getenv('DB_USER'),
+        "password": os.getenv('DB_PASSWORD'),
+        "port": os.getenv('DB_PORT'),
+        "client_encoding": 'utf8',
+        "application_name": os.getenv('DB_APPLICATION_NAME', 'map_api'),
+        "options": f"-c statement_timeout={os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000')}",
+        "row_factory": dict_row,
+    },
+    open=False,
+)
+
+# Requêtes traitées simultanément par route (les autres attendent leur tour)
+ROUTE_CONCURRENCY = int(os.getenv('ASGI_ROUTE_CONCURRENCY', os.getenv('DB_POOL_MAX', '10')))
+QUEUE_TIMEOUT = float(os.getenv('ASGI_QUEUE_TIMEOUT', '10'))
+_route_limits = {}
+_route_busy = {}
+
+# Verrous des états partagés de service.py (version des données, index de localisation)
+_data_version_lock = asyncio.Lock()
+_zone_locator_lock = asyncio.Lock()
+
+
+def _json_default(o):
+    # Mêmes conversions que le fournisseur JSON de Flask
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if isinstance(o, (datetime.date, datetime.datetime)):
+        return o.isoformat()
+    raise TypeError(f"Objet non sérialisable en JSON : {type(o).__name__}")
+
+
+class FlaskLikeJSONResponse(JSONResponse):
+    """JSON encodé comme par app.py (clés triées, compact, UTF-8 non échappé)"""
+
+    def render(self, content):
+        return json.dumps(content, ensure_ascii=False, sort_keys=True, separators=(',', ':'),
+                          default=_json_default).encode('utf-8')
+
+
+def error_response(message, status_code):
+    return FlaskLikeJSONResponse({"error": message}, status_code=status_code)
+
+
+async def fetch(plan):
+    """Exécute une requête de queries.py sur une connexion empruntée au pool"""
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            return await run_async(cur, plan)
+
+
+async def current_data_version():
+    """Version courante des données ; les caches sont vidés quand seed/ingest la changent"""
+    async with _data_version_lock:
+        if service.data_version.fresh():
+            return service.data_version.value
+        return service.data_version.update(await fetch(queries.data_version()))
+
+
+def request_keys(request, version):
+    """(clé de cache, ETag) de la requête"""
+    return service.request_keys(version, request.url.path, request.query_params.multi_items())
+
+
+def accepted_encodings(request):
+    encodings = set()
+    for item in request.headers.get('accept-encoding', '').split(','):
+        name, _, params = item.strip().partition(';')
+        q = params.strip()[2:] if params.strip().startswith('q=') else '1'
+        try:
+            if float(q) > 0:
+                encodings.add(name.strip().lower())
+        except ValueError:
+            pass
+    return encodings
+
+
+def encoding_filter(request):
+    """Prédicat « le client accepte cet encodage » (Accept-Encoding)"""
+    accepted = accepted_encodings(request)
+    return lambda encoding: encoding in accepted or '*' in accepted
+
+
+def matching_etag(request, etag, variants):
+    """ETag de la représentation négociée si le client la possède déjà (If-None-Match), sinon None"""
+    header = request.headers.get('if-none-match')
+    if not header:
+        return None
+    negotiated = service.negotiated_etag(etag, variants, encoding_filter(request))
+    tags = {t.strip().removeprefix('W/').strip('"') for t in header.split(',')}
+    return negotiated if negotiated in tags or '*' in tags else None
+
+
+def not_modified(etag, cache_control=None):
+    headers = {'Vary': 'Accept-Encoding', 'ETag': f'"{etag}"'}
+    if cache_control: headers['Cache-Control'] = cache_control
+    return Response(status_code=304, headers=headers)
+
+
+def variants_response(request, variants, media_type, etag, cache_control=None):
+    """Réponse dans l'encodage négocié, à partir des versions précompressées"""
+    encoding = service.negotiate_encoding(variants, encoding_filter(request))
+    headers = {'Vary': 'Accept-Encoding', 'ETag': f'"{variant_etag(etag, encoding)}"'}
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    if cache_control: headers['Cache-Control'] = cache_control
+    return Response(variants[encoding], media_type=media_type, headers=headers)
+
+
+def bounded(endpoint):
+    """Limite de concurrence de la route ; 503 si la file d'attente ou le pool sont saturés, 500 sinon"""
+    name = endpoint.__name__
+    limit = _route_limits.setdefault(name, asyncio.Semaphore(ROUTE_CONCURRENCY))
+    _route_busy.setdefault(name, 0)
+
+    @wraps(endpoint)
+    async def wrapper(request):
+        try:
+            await asyncio.wait_for(limit.acquire(), QUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Route {request.url.path} saturée ({ROUTE_CONCURRENCY} requêtes en cours)")
+            response = error_response(f"Route saturée après {QUEUE_TIMEOUT}s d'attente", 503)
+            response.headers['Retry-After'] = '1'
+            return response
+        _route_busy[name] += 1
+        try:
+            return await endpoint(request)
+        except PoolTimeout as e:
+            logger.warning(f"Pool de connexions saturé : {e}")
+            response = error_response(str(e), 503)
+            response.headers['Retry-After'] = '1'
+            return response
+        except Exception as e:
+            logger.error(f"Erreur {request.url.path}: {e}")
+            return error_response(str(e), 500)
+        finally:
+            _route_busy[name] -= 1
+            limit.release()
+    return wrapper
+
+
+def cached_response(endpoint, cache_control=None):
+    """Réponses 304 sur If-None-Match et cache du corps encodé (et compressé) des réponses 200.
+
+    `cache_control` est celui de la route : envoyé avec chaque 200 et chaque 304, que la
+    réponse soit encore en cache ou non.
+    """
+    @wraps(endpoint)
+    async def wrapper(request):
+        version = await current_data_version()
+        key, etag = request_keys(request, version)
+        entry = response_cache.get(key)
+        client_etag = matching_etag(request, etag, entry[0] if entry else VARIANT_ENCODINGS)
+        if client_etag:
+            return not_modified(client_etag, cache_control)
+        if entry is not None:
+            variants, media_type = entry
+            response = variants_response(request, variants, media_type, etag, cache_control)
+            response.headers['X-Cache'] = 'HIT'
+            return response
+
+        response = await endpoint(request)
+        if response.status_code == 200:
+            variants, size = compress_variants(response.body)
+            response_cache.set(key, (variants, response.media_type), size=size)
+            response = variants_response(request, variants, response.media_type, etag, cache_control)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+    return wrapper
+
+
+def route(path, endpoint, cached=True, cache_control=None):
+    return Route(path, bounded(cached_response(endpoint, cache_control) if cached else endpoint), methods=['GET'])
+
+
+def geometry_lod_from_request(request):
+    """(lod, décimales) demandés via ?zoom= ou ?tolerance= ; ValueError si invalide"""
+    return service.geometry_lod(request.query_params.get('zoom'), request.query_params.get('tolerance'))
+
+
+def json_text_response(body):
+    """JSON déjà sérialisé (par PostgreSQL ou queries.py)"""
+    return Response(body, media_type='application/json')
+
+
+def viewport_from_request(request):
+    """(bbox, clip) demandés via ?bbox= et ?clip= ; ValueError si bbox invalide"""
+    return service.viewport(request.query_params.get('bbox'), request.query_params.get('clip'))
+
+
+async def zone_topology(version, level, parent_id, lod, decimals, bbox=None, clip=False):
+    """Topologie TopoJSON des zones d'un niveau, construite hors de la boucle d'événements"""
+    key = service.topology_key(version, level, parent_id, lod, bbox, clip)
+    topology = topology_cache.get(key)
+    if topology is None:
+        features = await fetch(queries.zone_features(level, parent_id, lod, decimals, bbox, clip))
+        topology = await asyncio.to_thread(service.cache_topology, key, features)
+    return topology
+
+
+async def zone_locator():
+    """STRtree des contours des zones, construit hors de la boucle d'événements à chaque nouvelle version"""
+    version = await current_data_version()
+    async with _zone_locator_lock:
+        index = service.zone_locator.get(version)
+        if index is None:
+            rows = await fetch(queries.zone_geometries())
+            index = await asyncio.to_thread(service.zone_locator.build, version, rows)
+        return index
+
+
+# --- ROUTES (mêmes paramètres et réponses que app.py) ---
+
+async def get_zones(request):
+    level = request.query_params.get('level', 'REGION').upper()
+    try:
+        parent_id = service.parent_zone(request.query_params.get('parent_id'))
+        bbox, clip = viewport_from_request(request)
+        lod, decimals = geometry_lod_from_request(request)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    if request.query_params.get('format') == 'points':
+        return json_text_response(await fetch(queries.zones_points(level, parent_id, bbox)))
+    if request.query_params.get('format') == 'topojson':
+        return FlaskLikeJSONResponse(await zone_topology(await current_data_version(), level, parent_id, lod, decimals, bbox, clip))
+    return json_text_response(await fetch(queries.zones_collection(level, parent_id, lod, decimals, bbox, clip)))
+
+
+async def get_filters(request):
+    try:
+        parent_id = service.parent_zone(request.query_params.get('parent_id'))
+    except ValueError as e:
+        return error_response(str(e), 400)
+    return FlaskLikeJSONResponse(await fetch(queries.filters(parent_id)))
+
+
+async def get_map_data(request):
+    sub_sector_id = request.query_params.get('sector_id')
+    level = request.query_params.get('level', 'REGION').upper()
+    try:
+        parent_id = service.parent_zone(request.query_params.get('parent_id'))
+        bbox, clip = viewport_from_request(request)
+        lod, decimals = geometry_lod_from_request(request)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    if request.query_params.get('format') == 'topojson':
+        sector_info, values = await fetch(queries.map_values(sub_sector_id, level, parent_id, lod, bbox))
+        topology = await zone_topology(await current_data_version(), level, parent_id, lod, decimals, bbox, clip)
+        return FlaskLikeJSONResponse(queries.map_data_topojson(topology, sector_info, values))
+    body = await fetch(queries.map_data_geojson(sub_sector_id, level, parent_id, lod, decimals, bbox, clip))
+    return json_text_response(body)
+
+
+async def panel_section_response(section, zone_id, sector_id=None, year=None):
+    """Route individuelle d'une section du panneau ; 400 si zone_id, sector_id ou year sont invalides"""
+    try:
+        zone_id = queries.parse_int('zone_id', zone_id)
+        params = service.panel_params(sector_id, year)
+    except ValueError as e:
+        return error_response(str(e), 400)
+    return FlaskLikeJSONResponse(await fetch(section(zone_id, **params)))
+
+
+async def get_zone_stats(request):
+    return await panel_section_response(queries.zone_stats_section, request.query_params.get('zone_id'))
+
+
+async def get_evolution_stats(request):
+    return await panel_section_response(queries.evolution_section, request.query_params.get('zone_id'))
+
+
+async def get_comparison_stats(request):
+    return await panel_section_response(
+        queries.comparison_section, request.query_params.get('zone_id'),
+        sector_id=request.query_params.get('sector_id'), year=request.query_params.get('year')
+    )
+
+
+async def get_global_zone_stats(request):
+    return await panel_section_response(
+        queries.global_section, request.query_params.get('zone_id'), year=request.query_params.get('year')
+    )
+
+
+async def get_zone_panel(request):
+    args = request.query_params
+    try:
+        zone_ids = queries.parse_ids('zone_ids', args.get('zone_ids', args.get('zone_id')))
+        sections = service.panel_sections(args.get('sections'))
+        params = service.panel_params(args.get('sector_id'), args.get('year'))
+    except ValueError as e:
+        return error_response(str(e), 400)
+    return FlaskLikeJSONResponse(await fetch(queries.zone_panel(zone_ids, sections, **params)))
+
+
+async def search_zones(request):
+    query = request.query_params.get('q', '').strip()
+    if len(query) < 2:
+        return FlaskLikeJSONResponse([])
+    return FlaskLikeJSONResponse(await fetch(queries.search(query)))
+
+
+async def locate_points(request):
+    body = await request.body() if request.method == 'POST' else None
+    try:
+        if request.method == 'POST':
+            ids, lats, lons = read_points(body, request.headers.get('content-type'), LOCATE_MAX_POINTS)
+        else:
+            ids, lats, lons = service.query_point(request.query_params.get('lat'), request.query_params.get('lon'))
+    except ValueError as e:
+        return error_response(str(e), 400)
+
+    index = await zone_locator()
+    # Les gros lots sont localisés dans un thread pour ne pas bloquer les autres requêtes
+    results = await asyncio.to_thread(locate_results, index, ids, lats, lons)
+    if request.method == 'GET':
+        return FlaskLikeJSONResponse(results[0])
+    return FlaskLikeJSONResponse(service.locate_summary(results))
+
+
+async def get_tile(request):
+    layer = request.path_params['layer']
+    z, x, y = request.path_params['z'], request.path_params['x'], request.path_params['y']
+    level = service.tile_level(layer, z, x, y)
+    if level is None:
+        return error_response("Tuile inconnue", 404)
+    sub_sector_id = service.tile_sector(request.query_params.get('sector_id'))
+
+    version = await current_data_version()
+    _, etag = request_keys(request, version)
+    cache_key = service.tile_key(version, level, z, x, y, sub_sector_id)
+    variants = tile_cache.get(cache_key)
+    client_etag = matching_etag(request, etag, variants or VARIANT_ENCODINGS)
+    if client_etag:
+        return not_modified(client_etag, CACHE_CONTROL)
+
+    cache_status = 'HIT'
+    if variants is None:
+        cache_status = 'MISS'
+        lod, _ = pick_geometry_lod(zoom=z)
+        tile = await fetch(queries.vector_tile(level, z, x, y, lod, sub_sector_id, layer.lower()))
+        variants, size = compress_variants(tile)
+        tile_cache.set(cache_key, variants, size=size)
+
+    response = variants_response(request, variants, 'application/vnd.mapbox-vector-tile', etag, CACHE_CONTROL)
+    response.headers['X-Cache'] = cache_status
+    return response
+
+
+async def get_cache_stats(request):
+    return FlaskLikeJSONResponse(service.cache_stats(await current_data_version()))
+
+
+async def get_pool_stats(request):
+    """Statistiques du pool asynchrone et des files d'attente par route"""
+    return FlaskLikeJSONResponse({
+        **pool.get_stats(),
+        "route_concurrency": ROUTE_CONCURRENCY,
+        "routes_busy": dict(_route_busy),
+    })
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    try:
+        # Index de localisation chargé au démarrage (sinon à la première requête /api/gis/locate)
+        if os.getenv('LOCATE_WARMUP', '1') == '1':
+            try:
+                await zone_locator()
+            except Exception as e:
+                logger.warning(f"Index de localisation non chargé au démarrage : {e}")
+        yield
+    finally:
+        await pool.close()
+
+
+app = Starlette(
+    routes=[
+        route('/api/gis/zones', get_zones),
+        route('/api/filters', get_filters),
+        route('/api/map/data', get_map_data, cache_control=CACHE_CONTROL),
+        route('/api/zone/stats', get_zone_stats, cache_control=CACHE_CONTROL),
+        route('/api/stats/evolution', get_evolution_stats, cache_control=CACHE_CONTROL),
+        route('/api/stats/comparison', get_comparison_stats, cache_control=CACHE_CONTROL),
+        route('/api/stats/global', get_global_zone_stats, cache_control=CACHE_CONTROL),
+        route('/api/zone/panel', get_zone_panel, cache_control=CACHE_CONTROL),
+        route('/api/gis/search', search_zones, cache_control=CACHE_CONTROL),
+        Route('/api/gis/locate', bounded(locate_points), methods=['GET', 'POST']),
+        route('/api/tiles/{layer}/{z:int}/{x:int}/{y:int}.pbf', get_tile, cached=False),
+        route('/api/health/cache', get_cache_stats, cached=False),
+        route('/api/health/pool', get_pool_stats, cached=False),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+try:
+    import brotli
+except ImportError:  # brotli est optionnel : on se contente alors de gzip
+    brotli = None
+
+# En dessous de cette taille la compression ne vaut pas le coût CPU
+COMPRESSION_MIN_BYTES = 1024
+
+
+class LRUCache:
+    """Cache mémoire borné (nombre d'entrées et octets), éviction LRU, partagé entre threads.
+
+    Les valeurs sont des `bytes` (ou tout objet dont on fournit la taille à `set`).
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()   # clé -> (valeur, taille)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, size=None):
+        size = len(value) if size is None else size
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+# Encodages que compress_variants peut produire (tant que le corps n'est pas en cache,
+# l'encodage négocié est choisi parmi ceux-ci)
+VARIANT_ENCODINGS = ('identity', 'gzip') + (('br',) if brotli is not None else ())
+
+
+def compress_variants(body, gzip_level=6, brotli_quality=5):
+    """Corps brut et ses versions compressées, calculées une seule fois avant mise en cache.
+
+    Renvoie un dict encodage -> octets ('identity', 'gzip', 'br'), et la taille totale.
+    """
+    variants = {"identity": body}
+    if len(body) >= COMPRESSION_MIN_BYTES:
+        variants["gzip"] = gzip.compress(body, compresslevel=gzip_level)
+        if brotli is not None:
+            variants["br"] = brotli.compress(body, quality=brotli_quality)
+    return variants, sum(len(v) for v in variants.values())
+
+
+def normalized_cache_key(path, args):
+    """Route + paramètres normalisés (triés, sans valeurs vides) ; `args` est une suite de (clé, valeur)"""
+    args = sorted((k, v) for k, v in args if v not in ('', 'null', 'undefined'))
+    return f"{path}?{urlencode(args)}"
+
+
+def response_etag(version, cache_key):
+    """ETag fort : même version des données et mêmes paramètres => même contenu"""
+    return hashlib.sha1(f"{version}|{cache_key}".encode('utf-8')).hexdigest()
+
+
+def variant_etag(etag, encoding):
+    """Chaque encodage (gzip, br) est une représentation distincte, avec son propre ETag fort"""
+    return etag if encoding == 'identity' else f"{etag}-{encoding}"
@@ -0,0 +1,191 @@
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class PoolTimeout(Exception):
+    """Aucune connexion n'a pu être obtenue du pool dans le délai imparti."""
+
+
+class ConnectionPool:
+    """Pool de connexions psycopg2 partagé entre les threads de l'API.
+
+    - `minconn` connexions sont ouvertes au démarrage, jamais plus de `maxconn`.
+    - `getconn()` attend au plus `timeout` secondes qu'une connexion se libère.
+    - Une connexion restée inactive plus de `health_check_after` secondes est
+      vérifiée (SELECT 1) avant d'être rendue ; celles qui ont dépassé
+      `max_lifetime` sont recyclées.
+    """
+
+    def __init__(self, minconn, maxconn, timeout=10.0, health_check_after=30.0,
+                 max_lifetime=3600.0, **connect_kwargs):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"Tailles de pool invalides : min={minconn}, max={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self.max_lifetime = max_lifetime
+        self._connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []          # [(conn, rendue_a)]
+        self._born = {}          # id(conn) -> date de création
+        self._in_use = set()     # id(conn)
+        self._size = 0           # connexions ouvertes (libres + utilisées + en cours de création)
+        self._waiting = 0
+        self._counters = {"created": 0, "closed": 0, "checkouts": 0,
+                          "timeouts": 0, "health_check_failures": 0}
+
+        for _ in range(minconn):
+            self._size += 1
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(**self._connect_kwargs)
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self._born[id(conn)] = time.monotonic()
+            self._counters["created"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._born.pop(id(conn), None)
+            self._in_use.discard(id(conn))
+            self._size -= 1
+            self._counters["closed"] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if now - self._born.get(id(conn), now) > self.max_lifetime:
+            return False
+        if now - idle_since < self.health_check_after:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            idle_since = None
+            with self._cond:
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"Aucune connexion disponible après {self.timeout}s "
+                            f"({self._size}/{self.maxconn} utilisées)"
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    self._size += 1
+
+            if conn is None:
+                conn = self._connect()
+            elif not self._is_healthy(conn, idle_since):
+                with self._cond:
+                    self._counters["health_check_failures"] += 1
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._in_use.add(id(conn))
+                self._counters["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn):
+        with self._cond:
+            self._in_use.discard(id(conn))
+        if conn.closed:
+            self._discard(conn)
+            return
+        # On rend toujours une connexion propre (hors transaction) au pool
+        if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "min": self.minconn,
+                "max": self.maxconn,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": len(self._in_use),
+                "waiting": self._waiting,
+                **self._counters,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Pool global, créé au premier appel à partir des variables du .env."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                # Options de session appliquées dès la connexion (pas d'aller-retour supplémentaire)
+                options = f"-c statement_timeout={os.getenv('DB_STATEMENT_TIMEOUT_MS', '30000')}"
+                _pool = ConnectionPool(
+                    minconn=int(os.getenv('DB_POOL_MIN', '1')),
+                    maxconn=int(os.getenv('DB_POOL_MAX', '10')),
+                    timeout=float(os.getenv('DB_POOL_TIMEOUT', '10')),
+                    health_check_after=float(os.getenv('DB_POOL_HEALTH_CHECK_AFTER', '30')),
+                    max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+                    host=os.getenv('DB_HOST'),
+                    database=os.getenv('DB_NAME'),
+                    user=os.getenv('DB_USER'),
+                    password=os.getenv('DB_PASSWORD'),
+                    port=os.getenv('DB_PORT'),
+                    client_encoding='utf8',
+                    application_name=os.getenv('DB_APPLICATION_NAME', 'map_api'),
+                    options=options,
+                )
+    return _pool
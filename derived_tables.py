@@ -0,0 +1,228 @@
+"""Tables dérivées de administrative_zones / production_stats.
+
+Elles sont reconstruites par ingest_data.py et seed_data.py (les seuls scripts qui
+modifient les données) et lues directement par l'api. Chaque fonction prend une
+connexion SQLAlchemy ouverte ; le commit reste à la charge de l'appelant.
+"""
+import uuid
+
+from sqlalchemy import text
+
+# Garde-fou contre un éventuel cycle dans parent_id
+MAX_ZONE_DEPTH = 10
+
+
+def rebuild_zone_closure(conn):
+    """Table de fermeture ancêtre -> descendant (chaque zone est sa propre descendante, depth = 0)"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS zone_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            descendant_code VARCHAR(50),
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_zone_closure_ancestor_code ON zone_closure (ancestor_id, descendant_code);
+        CREATE INDEX IF NOT EXISTS idx_zone_closure_descendant ON zone_closure (descendant_id);
+        CREATE INDEX IF NOT EXISTS idx_zone_closure_code ON zone_closure (descendant_code);
+        TRUNCATE zone_closure;
+    """))
+    conn.execute(text("""
+        INSERT INTO zone_closure (ancestor_id, descendant_id, descendant_code, depth)
+        WITH RECURSIVE tree AS (
+            SELECT id AS ancestor_id, id AS descendant_id, 0 AS depth FROM administrative_zones
+            UNION ALL
+            SELECT t.ancestor_id, az.id, t.depth + 1 FROM administrative_zones az
+            JOIN tree t ON az.parent_id = t.descendant_id
+            WHERE t.depth < :max_depth
+        )
+        SELECT DISTINCT ON (t.ancestor_id, t.descendant_id) t.ancestor_id, t.descendant_id, d.code, t.depth
+        FROM tree t
+        JOIN administrative_zones d ON d.id = t.descendant_id
+        ORDER BY t.ancestor_id, t.descendant_id, t.depth
+    """), {"max_depth": MAX_ZONE_DEPTH})
+    conn.execute(text("ANALYZE zone_closure"))
+    return conn.execute(text("SELECT count(*) FROM zone_closure")).scalar()
+
+
+# Valeur de `year` des lignes de production_rollup qui cumulent toutes les années
+ALL_YEARS = 0
+
+
+def refresh_production_rollup(conn):
+    """Cube zone (sous-arbre complet) x sous-secteur x année de production_stats.
+
+    Une ligne par année et une ligne year = ALL_YEARS pour le cumul. Nécessite
+    une zone_closure à jour.
+    """
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS production_rollup (
+            zone_id INTEGER NOT NULL,
+            sub_sector_id INTEGER NOT NULL,
+            year INTEGER NOT NULL,
+            volume NUMERIC(17,2),
+            unit VARCHAR(20),
+            surface_area NUMERIC(17,2),
+            producer_count BIGINT,
+            average_price NUMERIC(15,2),
+            min_price NUMERIC(15,2),
+            max_price NUMERIC(15,2),
+            entry_count INTEGER NOT NULL,
+            PRIMARY KEY (zone_id, year, sub_sector_id)
+        );
+        TRUNCATE production_rollup;
+    """))
+    # Les codes sont dédoublonnés par zone racine : une ligne de production_stats
+    # n'est comptée qu'une fois par sous-arbre, comme avec `zone_code IN (...)`.
+    conn.execute(text("""
+        INSERT INTO production_rollup (
+            zone_id, sub_sector_id, year, volume, unit, surface_area, producer_count,
+            average_price, min_price, max_price, entry_count
+        )
+        SELECT d.zone_id, ps.sub_sector_id,
+               CASE WHEN GROUPING(ps.year) = 1 THEN :all_years ELSE ps.year END,
+               SUM(ps.volume), MAX(ps.unit), SUM(ps.surface_area), SUM(ps.producer_count),
+               SUM(ps.average_price * ps.volume) / NULLIF(SUM(ps.volume), 0),
+               MIN(ps.average_price), MAX(ps.average_price), COUNT(*)
+        FROM (
+            SELECT DISTINCT ancestor_id AS zone_id, descendant_code AS code
+            FROM zone_closure WHERE descendant_code IS NOT NULL
+        ) d
+        JOIN production_stats ps ON ps.zone_code = d.code AND ps.sub_sector_id IS NOT NULL
+        GROUP BY GROUPING SETS ((d.zone_id, ps.sub_sector_id, ps.year), (d.zone_id, ps.sub_sector_id))
+        HAVING GROUPING(ps.year) = 1 OR ps.year IS NOT NULL
+    """), {"all_years": ALL_YEARS})
+    conn.execute(text("ANALYZE production_rollup"))
+    return conn.execute(text("SELECT count(*) FROM production_rollup")).scalar()
+
+
+# Niveaux de détail des géométries : (lod, tolérance de simplification en degrés,
+# décimales conservées dans le GeoJSON, zoom minimal de la carte). Le lod 0 est la
+# géométrie d'origine de administrative_zones, les autres sont dans zone_geometry_lod.
+GEOMETRY_LODS = [
+    (0, 0.0, 9, 11),
+    (1, 0.001, 5, 9),
+    (2, 0.005, 4, 7),
+    (3, 0.02, 3, 0),
+]
+
+
+def pick_geometry_lod(zoom=None, tolerance=None):
+    """Choisit (lod, décimales) pour un zoom de carte ou une tolérance maximale en degrés"""
+    if zoom is not None:
+        for lod, _, decimals, min_zoom in GEOMETRY_LODS:
+            if zoom >= min_zoom:
+                return lod, decimals
+    if tolerance is not None:
+        for lod, lod_tolerance, decimals, _ in reversed(GEOMETRY_LODS):
+            if lod_tolerance <= tolerance:
+                return lod, decimals
+    return GEOMETRY_LODS[0][0], GEOMETRY_LODS[0][2]
+
+
+def coverage_simplify_available(conn):
+    """ST_CoverageSimplify utilisable (PostGIS >= 3.4 compilé avec GEOS >= 3.12)"""
+    if not conn.execute(text("SELECT EXISTS (SELECT 1 FROM pg_proc WHERE proname = 'st_coveragesimplify')")).scalar():
+        return False
+    geos = conn.execute(text("SELECT postgis_geos_version()")).scalar() or ''
+    major, minor = (int(part) for part in geos.split('-')[0].split('.')[:2])
+    return (major, minor) >= (3, 12)
+
+
+def rebuild_geometry_lods(conn):
+    """Versions simplifiées et arrondies des géométries de zone, frontières communes conservées.
+
+    Chaque niveau est simplifié comme une couverture (ST_CoverageSimplify) : une frontière
+    partagée par deux zones est simplifiée une seule fois, sans trou ni chevauchement entre
+    voisines, et reste un arc commun pour le TopoJSON. L'arrondi sur la grille est ensuite
+    identique de part et d'autre. Sans ST_CoverageSimplify, chaque zone est simplifiée seule
+    (ST_SimplifyPreserveTopology) et des écarts peuvent apparaître entre voisines.
+    """
+    if coverage_simplify_available(conn):
+        simplified = "ST_CoverageSimplify(geometry, :tolerance) OVER (PARTITION BY level)"
+    else:
+        simplified = "ST_SimplifyPreserveTopology(geometry, :tolerance)"
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS zone_geometry_lod (
+            zone_id INTEGER NOT NULL,
+            lod SMALLINT NOT NULL,
+            geometry geometry(MultiPolygon, 4326) NOT NULL,
+            PRIMARY KEY (lod, zone_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_zone_geometry_lod_geom ON zone_geometry_lod USING GIST (geometry);
+        TRUNCATE zone_geometry_lod;
+    """))
+    for lod, tolerance, decimals, _ in GEOMETRY_LODS[1:]:
+        # Une zone trop petite pour la grille disparaît : l'api retombe alors sur la géométrie d'origine
+        conn.execute(text(f"""
+            INSERT INTO zone_geometry_lod (zone_id, lod, geometry)
+            SELECT id, :lod, geom FROM (
+                SELECT id, ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_SnapToGrid(simplified, :grid)), 3)) AS geom
+                FROM (
+                    SELECT id, {simplified} AS simplified
+                    FROM administrative_zones
+                    WHERE geometry IS NOT NULL
+                ) coverage
+            ) snapped
+            WHERE NOT ST_IsEmpty(geom)
+        """), {"lod": lod, "tolerance": tolerance, "grid": 10 ** -decimals})
+    conn.execute(text("ANALYZE zone_geometry_lod"))
+    return conn.execute(text("SELECT count(*) FROM zone_geometry_lod")).scalar()
+
+
+# Repères précalculés de chaque zone (étiquettes, marqueurs, recadrage de la carte sans contours) :
+# centroïde, point intérieur pour l'étiquette, emprise [minLon, minLat, maxLon, maxLat] et surface
+ZONE_GEOMETRY_SUMMARY_SQL = """
+    ALTER TABLE administrative_zones
+        ADD COLUMN IF NOT EXISTS centroid geometry(Point, 4326),
+        ADD COLUMN IF NOT EXISTS label_point geometry(Point, 4326),
+        ADD COLUMN IF NOT EXISTS bbox DOUBLE PRECISION[],
+        ADD COLUMN IF NOT EXISTS area_km2 DOUBLE PRECISION;
+    UPDATE administrative_zones SET
+        centroid = ST_SnapToGrid(ST_Centroid(geometry), 0.000001),
+        label_point = ST_SnapToGrid(ST_PointOnSurface(geometry), 0.000001),
+        bbox = ARRAY[ST_XMin(geometry), ST_YMin(geometry), ST_XMax(geometry), ST_YMax(geometry)],
+        area_km2 = round((ST_Area(geometry::geography) / 1e6)::numeric, 3)::float8
+    WHERE geometry IS NOT NULL;
+"""
+
+
+def refresh_zone_geometry_summary(conn):
+    """Centroïde, point d'étiquette, emprise et surface (km²) de chaque zone"""
+    conn.execute(text(ZONE_GEOMETRY_SUMMARY_SQL))
+    return conn.execute(text("SELECT count(*) FROM administrative_zones WHERE label_point IS NOT NULL")).scalar()
+
+
+def set_dataset_metadata(conn, key, value):
+    """Écrit une valeur de dataset_metadata (version des données, nombre de changements...)"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS dataset_metadata (
+            key VARCHAR(50) PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """))
+    conn.execute(text("""
+        INSERT INTO dataset_metadata (key, value, updated_at) VALUES (:key, :value, now())
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = EXCLUDED.updated_at
+    """), {"key": key, "value": str(value)})
+
+
+def bump_data_version(conn):
+    """Nouvelle version du jeu de données : invalide les caches de l'api (réponses, tuiles, ETag)"""
+    version = uuid.uuid4().hex
+    set_dataset_metadata(conn, 'data_version', version)
+    return version
+
+
+def ensure_zone_search_index(conn):
+    """Recherche de zones insensible aux accents/à la casse : fonction de normalisation + index trigramme"""
+    conn.execute(text("""
+        CREATE EXTENSION IF NOT EXISTS unaccent;
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        CREATE OR REPLACE FUNCTION normalize_zone_name(text) RETURNS text AS $$
+            SELECT trim(regexp_replace(lower(public.unaccent('public.unaccent'::regdictionary, $1)), '[^a-z0-9]+', ' ', 'g'))
+        $$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+        CREATE INDEX IF NOT EXISTS idx_zones_name_trgm
+            ON administrative_zones USING GIN (normalize_zone_name(name) gin_trgm_ops);
+    """))
@@ -0,0 +1,148 @@
+"""Localisation inverse (point GPS -> zones) servie depuis la mémoire.
+
+Les contours de administrative_zones sont chargés une fois dans un STRtree de géométries
+préparées (shapely 2) ; un lot de points est localisé en une seule requête vectorisée sur
+l'arbre, sans interroger PostGIS. Utilisé par app.py et asgi_app.py (/api/gis/locate).
+"""
+import csv
+import io
+import json
+
+import numpy as np
+import shapely
+
+# Profondeur des niveaux : pour un point, la zone retenue est la plus profonde qui le contient
+LEVEL_DEPTH = {'COUNTRY': 0, 'REGION': 1, 'DEPARTEMENT': 2, 'ARRONDISSEMENT': 3}
+
+LAT_COLUMNS = ('lat', 'latitude')
+LON_COLUMNS = ('lon', 'lng', 'long', 'longitude')
+
+
+class ZoneLocator:
+    """Index spatial des zones ; `locate` renvoie pour chaque point la zone et ses parents"""
+
+    def __init__(self, rows):
+        rows = sorted(rows, key=lambda r: r['id'])
+        self.ids = np.array([r['id'] for r in rows], dtype=np.int64)
+        self.depths = np.array([LEVEL_DEPTH.get(r['level'], -1) for r in rows], dtype=np.int64)
+        self.geometries = shapely.from_wkb([bytes(r['wkb']) for r in rows])
+        shapely.prepare(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+
+        # Chaîne de chaque zone (zone + parents, du pays au parent direct), calculée une fois
+        zones = {r['id']: {"id": r['id'], "name": r['name'], "level": r['level'], "code": r['code']} for r in rows}
+        parent_of = {r['id']: r['parent_id'] for r in rows}
+        self.chains = {}
+        for zone_id, zone in zones.items():
+            parents = []
+            parent_id = parent_of[zone_id]
+            while parent_id in zones and len(parents) < len(LEVEL_DEPTH):
+                parents.append(zones[parent_id])
+                parent_id = parent_of[parent_id]
+            self.chains[zone_id] = {"zone": zone, "parents": parents[::-1]}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def locate(self, lats, lons):
+        """Chaîne de zones de chaque point (None hors de toute zone)"""
+        points = shapely.points(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        # L'arbre ne filtre que par emprise ; le test exact se fait ensuite sur les polygones
+        # préparés (un prédicat passé à query préparerait les points, pas les polygones)
+        point_idx, geom_idx = self.tree.query(points)
+        inside = shapely.intersects(self.geometries[geom_idx], points[point_idx])
+        point_idx, geom_idx = point_idx[inside], geom_idx[inside]
+        deepest = np.full(len(points), -1, dtype=np.int64)
+        if len(point_idx):
+            # Tri par point, puis zone la plus profonde, puis plus petit id (point sur une frontière)
+            order = np.lexsort((geom_idx, -self.depths[geom_idx], point_idx))
+            point_idx, geom_idx = point_idx[order], geom_idx[order]
+            first = np.r_[True, point_idx[1:] != point_idx[:-1]]
+            deepest[point_idx[first]] = geom_idx[first]
+        return [self.chains[int(self.ids[g])] if g >= 0 else None for g in deepest]
+
+
+def _coordinates(lats, lons, max_points):
+    if not lats:
+        raise ValueError("Aucun point à localiser")
+    if len(lats) > max_points:
+        raise ValueError(f"Trop de points ({len(lats)}), maximum {max_points} par requête")
+    try:
+        lats = np.asarray(lats, dtype=float)
+        lons = np.asarray(lons, dtype=float)
+    except (TypeError, ValueError):
+        raise ValueError("Coordonnées non numériques")
+    if not (np.isfinite(lats).all() and np.isfinite(lons).all()
+            and (np.abs(lats) <= 90).all() and (np.abs(lons) <= 180).all()):
+        raise ValueError("Coordonnées hors limites (lat entre -90 et 90, lon entre -180 et 180)")
+    return lats, lons
+
+
+def _pick(item, names):
+    return next((item[name] for name in names if name in item), None)
+
+
+def points_from_json(data, max_points):
+    """(ids, lats, lons) d'un corps JSON : un point, une liste de points ou {"points": [...]}.
+
+    Un point est {"lat": .., "lon": .., "id": ..} (id facultatif, renvoyé tel quel) ou [lat, lon].
+    """
+    if isinstance(data, dict):
+        data = data['points'] if 'points' in data else [data]
+    if not isinstance(data, list):
+        raise ValueError("Corps JSON attendu : un point, une liste de points ou {\"points\": [...]}")
+    ids, lats, lons = [], [], []
+    for item in data:
+        if isinstance(item, dict):
+            ids.append(item.get('id'))
+            lats.append(_pick(item, LAT_COLUMNS))
+            lons.append(_pick(item, LON_COLUMNS))
+        elif isinstance(item, (list, tuple)) and len(item) == 2:
+            ids.append(None)
+            lats.append(item[0])
+            lons.append(item[1])
+        else:
+            raise ValueError(f"Point invalide : {item!r}")
+    return (ids, *_coordinates(lats, lons, max_points))
+
+
+def points_from_csv(text, max_points):
+    """(ids, lats, lons) d'un CSV avec en-tête (lat/latitude, lon/lng/longitude, id facultatif)"""
+    reader = csv.DictReader(io.StringIO(text))
+    header = [name.strip().lower() for name in reader.fieldnames or []]
+    lat_col = next((c for c in LAT_COLUMNS if c in header), None)
+    lon_col = next((c for c in LON_COLUMNS if c in header), None)
+    if lat_col is None or lon_col is None:
+        raise ValueError("En-tête CSV attendu : lat,lon (id facultatif)")
+    reader.fieldnames = header
+    ids, lats, lons = [], [], []
+    for row in reader:
+        ids.append(row.get('id'))
+        lats.append(row[lat_col])
+        lons.append(row[lon_col])
+    return (ids, *_coordinates(lats, lons, max_points))
+
+
+def read_points(body, content_type, max_points):
+    """Points d'un corps de requête POST, en JSON ou en CSV (selon le Content-Type)"""
+    text = body.decode('utf-8-sig') if isinstance(body, bytes) else body
+    if 'csv' in (content_type or ''):
+        return points_from_csv(text, max_points)
+    try:
+        data = json.loads(text)
+    except ValueError:
+        raise ValueError("Corps JSON invalide")
+    return points_from_json(data, max_points)
+
+
+def locate_results(locator, ids, lats, lons):
+    """Résultat par point : coordonnées, id éventuel, zone la plus profonde et ses parents"""
+    results = []
+    for point_id, lat, lon, chain in zip(ids, lats, lons, locator.locate(lats, lons)):
+        result = {"lat": float(lat), "lon": float(lon), "zone": None, "parents": []}
+        if point_id is not None:
+            result["id"] = point_id
+        if chain:
+            result.update(chain)
+        results.append(result)
+    return results
@@ -1,8 +1,26 @@
+import io
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
 import geopandas as gpd
+import pyogrio
+import shapely
 from sqlalchemy import create_engine, text
 from dotenv import load_dotenv
-from shapely.geometry import Polygon, MultiPolygon
+from derived_tables import (
+    rebuild_zone_closure, refresh_production_rollup, rebuild_geometry_lods,
+    refresh_zone_geometry_summary, ensure_zone_search_index, bump_data_version, coverage_simplify_available
+)
+from migrate import ZONE_PARENT_FK_SQL, ensure_zone_indexes
+
+try:
+    import pyarrow  # noqa: F401
+    USE_ARROW = True
+except ImportError:  # pyarrow est optionnel : lecture classique par pyogrio
+    USE_ARROW = False
 
 load_dotenv()
 
@@ -15,6 +33,15 @@ db_name = os.getenv("DB_NAME")
 DB_URL = f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
 engine = create_engine(DB_URL)
 
+# Niveaux GADM : (rang, niveau, fichier, colonnes possibles du nom). Le code GADM d'une zone
+# est dans GID_<rang>, celui de son parent dans GID_<rang - 1>.
+GADM_LEVELS = [
+    (0, 'COUNTRY', "shapes/gadm41_CMR_0.shp", ('COUNTRY', 'NAME_0')),
+    (1, 'REGION', "shapes/gadm41_CMR_1.shp", ('NAME_1',)),
+    (2, 'DEPARTEMENT', "shapes/gadm41_CMR_2.shp", ('NAME_2',)),
+    (3, 'ARRONDISSEMENT', "shapes/gadm41_CMR_3.shp", ('NAME_3',)),
+]
+
 def reset_database():
     print("--- 🧹 Nettoyage ---")
     with engine.connect() as conn:
@@ -23,90 +50,205 @@ def reset_database():
         conn.execute(text("DROP TABLE IF EXISTS temp_arrondissements;"))
         conn.commit()
 
+@contextmanager
+def stage(label, timings):
+    """Chronomètre une étape de l'ingestion"""
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    timings.append((label, elapsed))
+    print(f"⏱️  {label} : {elapsed:.2f}s")
+
 def prepare_gdf(gdf):
     if gdf.crs is None: gdf = gdf.set_crs("EPSG:4326")
     else: gdf = gdf.to_crs("EPSG:4326")
 
-    def force_multi(geom):
-        return MultiPolygon([geom]) if isinstance(geom, Polygon) else geom
-
-    gdf["geometry"] = gdf["geometry"].apply(force_multi)
-    return gdf
+    # Polygon -> MultiPolygon sur tout le tableau de géométries d'un coup (pas de .apply ligne à ligne)
+    geoms = gdf.geometry.to_numpy().copy()
+    single = shapely.get_type_id(geoms) == shapely.GeometryType.POLYGON
+    if single.any():
+        geoms[single] = shapely.multipolygons(geoms[single], indices=np.arange(single.sum()))
+    return gdf.set_geometry(gpd.GeoSeries(geoms, index=gdf.index, crs=gdf.crs))
+
+def read_level(level_def):
+    """Lit et prépare un niveau GADM ; renvoie les lignes prêtes pour COPY (géométrie en EWKB hexadécimal)"""
+    rank, level, path, name_columns = level_def
+    start = time.perf_counter()
+    fields = set(pyogrio.read_info(path)["fields"])
+    name_col = next(c for c in name_columns if c in fields)
+    gid_col = f"GID_{rank}" if f"GID_{rank}" in fields else None
+    parent_gid_col = f"GID_{rank - 1}" if rank > 0 and f"GID_{rank - 1}" in fields else None
+    columns = [c for c in (name_col, gid_col, parent_gid_col) if c]
+    gdf = gpd.read_file(path, columns=columns, encoding="utf-8", engine="pyogrio", use_arrow=USE_ARROW)
+    read_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    gdf = prepare_gdf(gdf)
+    geoms = shapely.set_srid(gdf.geometry.to_numpy(), 4326)
+    rows = pd.DataFrame({
+        "rank": rank,
+        "ord": np.arange(len(gdf)),
+        "level": level,
+        "name": gdf[name_col].to_numpy(),
+        "gid": gdf[gid_col].to_numpy() if gid_col else None,
+        "parent_gid": gdf[parent_gid_col].to_numpy() if parent_gid_col else None,
+        "geometry": shapely.to_wkb(geoms, hex=True, include_srid=True),
+    })
+    return level, rows, read_seconds, time.perf_counter() - start
+
+def copy_zone_staging(conn, rows):
+    """Envoie toutes les zones lues dans la table temporaire zone_staging par un seul COPY"""
+    conn.execute(text("""
+        CREATE TEMP TABLE zone_staging (
+            rank SMALLINT NOT NULL,
+            ord INTEGER NOT NULL,
+            level VARCHAR(20) NOT NULL,
+            name TEXT,
+            gid VARCHAR(50),
+            parent_gid VARCHAR(50),
+            geometry geometry(MultiPolygon, 4326)
+        ) ON COMMIT DROP
+    """))
+    buf = io.StringIO()
+    rows.to_csv(buf, index=False, header=False)
+    buf.seek(0)
+    cur = conn.connection.cursor()
+    try:
+        # PostGIS lit directement l'EWKB hexadécimal dans la colonne geometry
+        cur.copy_expert(
+            "COPY zone_staging (rank, ord, level, name, gid, parent_gid, geometry) FROM STDIN WITH (FORMAT csv)", buf
+        )
+        return cur.rowcount
+    finally:
+        cur.close()
+
+def create_zones_table(conn):
+    conn.execute(text("""
+        CREATE TABLE administrative_zones (
+            id SERIAL PRIMARY KEY,
+            name TEXT,
+            level TEXT,
+            parent_id INTEGER,
+            code VARCHAR(50),
+            gid VARCHAR(50),
+            geometry geometry(MultiPolygon, 4326),
+            centroid geometry(Point, 4326),
+            label_point geometry(Point, 4326),
+            bbox DOUBLE PRECISION[],
+            area_km2 DOUBLE PRECISION
+        );
+    """ + ZONE_PARENT_FK_SQL))
+
+def insert_zones(conn):
+    """Insère les zones niveau par niveau, chacune rattachée à son parent du niveau précédent.
+
+    Le parent est trouvé par son code GADM (GID), sinon par la zone du niveau précédent qui
+    contient un point de la zone (ST_PointOnSurface, index GiST). Le GID sert aussi de code
+    initial ; seed_data.py le remplace par le pcode du CSV quand il en trouve un.
+    Renvoie {niveau: (zones insérées, zones sans parent)}.
+    """
+    counts = {}
+    parent_level = None
+    for rank, level, _, _ in GADM_LEVELS:
+        conn.execute(text("""
+            INSERT INTO administrative_zones (name, level, geometry, gid, code, parent_id)
+            SELECT t.name, t.level, t.geometry, t.gid, t.gid, COALESCE(by_gid.id, by_point.id)
+            FROM zone_staging t
+            LEFT JOIN administrative_zones by_gid ON by_gid.gid = t.parent_gid AND by_gid.level = :parent_level
+            LEFT JOIN LATERAL (
+                SELECT p.id FROM administrative_zones p
+                WHERE by_gid.id IS NULL AND p.level = :parent_level
+                  AND ST_Contains(p.geometry, ST_PointOnSurface(t.geometry))
+                ORDER BY p.id LIMIT 1
+            ) by_point ON true
+            WHERE t.rank = :rank
+            ORDER BY t.ord
+        """), {"rank": rank, "parent_level": parent_level})
+        # Statistiques à jour pour que le niveau suivant utilise les index gid et GiST
+        conn.execute(text("ANALYZE administrative_zones"))
+        counts[level] = conn.execute(text("""
+            SELECT count(*), count(*) FILTER (WHERE parent_id IS NULL) FROM administrative_zones WHERE level = :level
+        """), {"level": level}).fetchone()
+        parent_level = level
+    return counts
 
 def ingest_all():
+    timings = []
     try:
-        # 1. PAYS
-        print("--- 1. Pays ---")
-        gdf_0 = gpd.read_file("shapes/gadm41_CMR_0.shp", encoding="utf-8")
-        gdf_0 = prepare_gdf(gdf_0)
-        col_0 = 'COUNTRY' if 'COUNTRY' in gdf_0.columns else 'NAME_0'
-        gdf_0 = gdf_0.rename(columns={col_0: 'name'})[['name', 'geometry']]
-        gdf_0['level'] = 'COUNTRY'
-        gdf_0['parent_id'] = None
-        gdf_0.to_postgis('administrative_zones', engine, if_exists='replace', index=False)
-
-        with engine.connect() as conn:
-            conn.execute(text("ALTER TABLE administrative_zones ADD COLUMN id SERIAL PRIMARY KEY;"))
-            conn.commit()
+        # 1. Lecture des quatre niveaux en parallèle (E/S et GDAL hors du GIL)
+        print("--- 1. Lecture des contours GADM ---")
+        with stage("lecture + préparation (parallèle)", timings):
+            with ThreadPoolExecutor(max_workers=len(GADM_LEVELS)) as executor:
+                results = list(executor.map(read_level, GADM_LEVELS))
+        for level, rows, read_seconds, prepare_seconds in results:
+            print(f"   {level} : {len(rows)} zones (lecture {read_seconds:.2f}s, préparation {prepare_seconds:.2f}s)")
+        staged = pd.concat([rows for _, rows, _, _ in results], ignore_index=True)
 
-        # 2. REGIONS
-        print("--- 2. Régions ---")
         with engine.connect() as conn:
-            cid = conn.execute(text("SELECT id FROM administrative_zones WHERE level='COUNTRY' LIMIT 1")).scalar()
-
-        gdf_1 = gpd.read_file("shapes/gadm41_CMR_1.shp", encoding="utf-8")
-        gdf_1 = prepare_gdf(gdf_1)
-        gdf_1 = gdf_1.rename(columns={'NAME_1': 'name'})[['name', 'geometry']]
-        gdf_1['level'] = 'REGION'
-        gdf_1['parent_id'] = cid
-        gdf_1.to_postgis('administrative_zones', engine, if_exists='append', index=False)
-
-        # 3. DEPARTEMENTS (Liaison robuste avec LOWER())
-        print("--- 3. Départements ---")
-        gdf_2 = gpd.read_file("shapes/gadm41_CMR_2.shp", encoding="utf-8")
-        gdf_2 = prepare_gdf(gdf_2)
-        gdf_2 = gdf_2.rename(columns={'NAME_2': 'name', 'NAME_1': 'p_name'})[['name', 'p_name', 'geometry']]
-        gdf_2['level'] = 'DEPARTEMENT'
-        gdf_2.to_postgis('temp_departements', engine, if_exists='replace')
-
-        with engine.connect() as conn:
-            # On utilise LOWER() et TRIM() pour être sûr que "CENTRE" matche avec "Centre"
-            conn.execute(text("""
-                INSERT INTO administrative_zones (name, level, geometry, parent_id)
-                SELECT t.name, 'DEPARTEMENT', t.geometry, p.id
-                FROM temp_departements t
-                JOIN administrative_zones p ON LOWER(TRIM(t.p_name)) = LOWER(TRIM(p.name))
-                WHERE p.level = 'REGION'
-            """))
+            # 2. Chargement en bloc (COPY) puis insertion par niveau
+            print("--- 2. Chargement des zones ---")
+            with stage("COPY zone_staging", timings):
+                copied = copy_zone_staging(conn, staged)
+            print(f"   {copied} zones envoyées.")
+            # Index (B-tree et GiST) posés avant l'insertion : la liaison des parents s'en sert
+            with stage("insertion et liaison des parents", timings):
+                create_zones_table(conn)
+                ensure_zone_indexes(conn)
+                counts = insert_zones(conn)
             conn.commit()
-
-        # 4. ARRONDISSEMENTS (Liaison robuste avec LOWER())
-        print("--- 4. Arrondissements ---")
-        gdf_3 = gpd.read_file("shapes/gadm41_CMR_3.shp", encoding="utf-8")
-        gdf_3 = prepare_gdf(gdf_3)
-        gdf_3 = gdf_3.rename(columns={'NAME_3': 'name', 'NAME_2': 'p_name'})[['name', 'p_name', 'geometry']]
-        gdf_3['level'] = 'ARRONDISSEMENT'
-        gdf_3.to_postgis('temp_arrondissements', engine, if_exists='replace')
-
-        with engine.connect() as conn:
-            # On utilise LOWER() et TRIM() pour être sûr que "MFOUNDI" matche avec "Mfoundi"
-            conn.execute(text("""
-                INSERT INTO administrative_zones (name, level, geometry, parent_id)
-                SELECT t.name, 'ARRONDISSEMENT', t.geometry, p.id
-                FROM temp_arrondissements t
-                JOIN administrative_zones p ON LOWER(TRIM(t.p_name)) = LOWER(TRIM(p.name))
-                WHERE p.level = 'DEPARTEMENT'
-            """))
+            for rank, level, _, _ in GADM_LEVELS:
+                inserted, orphans = counts[level]
+                warning = f" (⚠️ {orphans} sans parent)" if rank > 0 and orphans else ""
+                print(f"✅ {inserted} zones {level} insérées{warning}.")
+
+            # Centroïde, point d'étiquette, emprise et surface : servis sans les contours
+            with stage("repères des zones", timings):
+                summarized = refresh_zone_geometry_summary(conn)
+                conn.commit()
+            print(f"✅ Repères calculés pour {summarized} zones.")
+
+            # 3. Table de fermeture (ancêtre -> descendants) utilisée par l'api
+            print("--- 3. Table de fermeture des zones ---")
+            with stage("zone_closure", timings):
+                pairs = rebuild_zone_closure(conn)
+                conn.commit()
+            print(f"✅ zone_closure : {pairs} couples ancêtre/descendant.")
+
+            # Index de recherche par nom (la table vient d'être recréée)
+            with stage("index de recherche", timings):
+                ensure_zone_search_index(conn)
+                conn.commit()
+
+            # 4. Géométries simplifiées (niveaux de détail) servies selon le zoom
+            print("--- 4. Niveaux de détail des géométries ---")
+            if not coverage_simplify_available(conn):
+                print("⚠️ ST_CoverageSimplify indisponible (PostGIS >= 3.4 / GEOS >= 3.12 requis) : "
+                      "zones simplifiées une à une, des écarts peuvent apparaître entre voisines.")
+            with stage("zone_geometry_lod", timings):
+                lods = rebuild_geometry_lods(conn)
+                conn.commit()
+            print(f"✅ zone_geometry_lod : {lods} géométries simplifiées.")
+
+            # Les identifiants de zones ont changé : le cube est recalculé (si des stats existent déjà)
+            if conn.execute(text("SELECT to_regclass('production_stats')")).scalar():
+                with stage("production_rollup", timings):
+                    cells = refresh_production_rollup(conn)
+                    conn.commit()
+                print(f"✅ production_rollup : {cells} cellules.")
+
+            # Invalide les caches de l'api
+            version = bump_data_version(conn)
             conn.commit()
-
-            # Vérification du nombre d'arrondissements insérés
-            count = conn.execute(text("SELECT count(*) FROM administrative_zones WHERE level='ARRONDISSEMENT'")).scalar()
-            print(f"✅ {count} Arrondissements insérés avec succès !")
-
-            conn.execute(text("DROP TABLE temp_departements; DROP TABLE temp_arrondissements;"))
+            print(f"✅ Version des données : {version}")
 
     except Exception as e:
         print(f"❌ Erreur : {e}")
+    finally:
+        if timings:
+            print("--- Durées ---")
+            for label, elapsed in timings:
+                print(f"   {label:<36} {elapsed:6.2f}s")
+            print(f"   {'total':<36} {sum(e for _, e in timings):6.2f}s")
 
 if __name__ == "__main__":
     reset_database()
@@ -0,0 +1,119 @@
+import os
+from sqlalchemy import create_engine, text
+from dotenv import load_dotenv
+from derived_tables import ZONE_GEOMETRY_SUMMARY_SQL
+
+# Charger les variables d'environnement
+load_dotenv()
+
+# Configuration de la connexion DB
+DB_USER = os.getenv("DB_USER")
+DB_PASSWORD = os.getenv("DB_PASSWORD")
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_NAME = os.getenv("DB_NAME")
+
+DB_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+engine = create_engine(DB_URL)
+
+# Index de administrative_zones, aussi créés par ingest_data.py quand il recrée la table
+ZONE_INDEXES_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_administrative_zones_code ON administrative_zones (code);
+    CREATE INDEX IF NOT EXISTS idx_administrative_zones_level ON administrative_zones (level);
+    CREATE INDEX IF NOT EXISTS idx_administrative_zones_parent_id ON administrative_zones (parent_id);
+    CREATE INDEX IF NOT EXISTS idx_administrative_zones_geometry ON administrative_zones USING GIST (geometry);
+"""
+
+# Code GADM (GID) des zones, utilisé par ingest_data.py pour rattacher chaque zone à son parent
+ZONE_GID_INDEX_SQL = """
+    CREATE INDEX IF NOT EXISTS idx_administrative_zones_gid ON administrative_zones (gid);
+"""
+
+# Clé étrangère parent_id -> id (un parent supprimé détache ses enfants)
+ZONE_PARENT_FK_SQL = """
+    ALTER TABLE administrative_zones DROP CONSTRAINT IF EXISTS fk_administrative_zones_parent;
+    ALTER TABLE administrative_zones ADD CONSTRAINT fk_administrative_zones_parent
+        FOREIGN KEY (parent_id) REFERENCES administrative_zones (id) ON DELETE SET NULL;
+"""
+
+def ensure_zone_indexes(conn):
+    conn.execute(text(ZONE_INDEXES_SQL + ZONE_GID_INDEX_SQL))
+
+# Migrations versionnées : (version, nom, SQL). Chacune est rejouable sans erreur
+# (IF NOT EXISTS, conversions conditionnelles) et n'est appliquée qu'une fois,
+# son numéro étant enregistré dans schema_migrations.
+MIGRATIONS = [
+    (1, "administrative_zones.code", """
+        ALTER TABLE administrative_zones ADD COLUMN IF NOT EXISTS code VARCHAR(50);
+    """),
+    (2, "administrative_zones.parent_id en INTEGER avec clé étrangère", """
+        DO $$
+        DECLARE
+            parent_type TEXT;
+        BEGIN
+            SELECT data_type INTO parent_type FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'administrative_zones'
+              AND column_name = 'parent_id';
+            IF parent_type IN ('text', 'character varying') THEN
+                -- Valeurs non numériques (ou vides) : zone sans parent
+                UPDATE administrative_zones SET parent_id = NULL WHERE parent_id !~ '^\\s*[0-9]+(\\.0+)?\\s*$';
+                ALTER TABLE administrative_zones
+                    ALTER COLUMN parent_id TYPE INTEGER USING parent_id::numeric::integer;
+            ELSIF parent_type <> 'integer' THEN
+                -- bigint, numeric, double precision (to_postgis) : conversion directe
+                ALTER TABLE administrative_zones
+                    ALTER COLUMN parent_id TYPE INTEGER USING parent_id::integer;
+            END IF;
+        END $$;
+        -- Parents disparus : la contrainte ne pourrait pas être posée
+        UPDATE administrative_zones c SET parent_id = NULL
+        WHERE parent_id IS NOT NULL AND NOT EXISTS (SELECT 1 FROM administrative_zones p WHERE p.id = c.parent_id);
+    """ + ZONE_PARENT_FK_SQL),
+    (3, "index B-tree et GiST", ZONE_INDEXES_SQL + """
+        CREATE INDEX IF NOT EXISTS idx_production_stats_zone_code ON production_stats (zone_code);
+    """),
+    (4, "administrative_zones.gid", """
+        ALTER TABLE administrative_zones ADD COLUMN IF NOT EXISTS gid VARCHAR(50);
+    """ + ZONE_GID_INDEX_SQL),
+    (5, "centroïde, point d'étiquette, emprise et surface des zones", ZONE_GEOMETRY_SUMMARY_SQL),
+]
+
+def run_migrations(conn):
+    """Applique les migrations pas encore enregistrées ; renvoie les versions appliquées"""
+    conn.execute(text("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """))
+    done = set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+    applied = []
+    for version, name, sql in MIGRATIONS:
+        if version in done:
+            continue
+        print(f"   -> {version:03d} {name}")
+        conn.execute(text(sql))
+        conn.execute(text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                     {"version": version, "name": name})
+        applied.append(version)
+    return applied
+
+def migrate():
+    print("--- 🧱 Migrations du schéma ---")
+    try:
+        with engine.connect() as conn:
+            applied = run_migrations(conn)
+            conn.commit()
+            # Statistiques à jour pour que le planificateur utilise les nouveaux index
+            conn.execute(text("ANALYZE administrative_zones; ANALYZE production_stats;"))
+            conn.commit()
+            if applied:
+                print(f"✅ {len(applied)} migration(s) appliquée(s).")
+            else:
+                print("✅ Schéma déjà à jour.")
+    except Exception as e:
+        print(f"❌ Erreur lors des migrations : {e}")
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,472 @@
+"""Requêtes de lecture de l'api, communes à app.py (Flask, psycopg2) et asgi_app.py (psycopg 3 async).
+
+Chaque requête est écrite comme un générateur : il produit des couples (sql, params),
+reçoit en retour les lignes (dicts) et renvoie le résultat final. `run_sync` l'exécute
+avec un curseur psycopg2 (RealDictCursor), `run_async` avec un curseur asynchrone
+psycopg 3 (dict_row) ; le SQL et la mise en forme ne sont écrits qu'une fois.
+"""
+import json
+import math
+
+from derived_tables import ALL_YEARS
+
+
+def run_sync(cur, plan):
+    try:
+        sql, params = next(plan)
+        while True:
+            cur.execute(sql, params)
+            sql, params = plan.send(cur.fetchall() if cur.description else [])
+    except StopIteration as done:
+        return done.value
+
+
+async def run_async(cur, plan):
+    try:
+        sql, params = next(plan)
+        while True:
+            await cur.execute(sql, params)
+            sql, params = plan.send(await cur.fetchall() if cur.description else [])
+    except StopIteration as done:
+        return done.value
+
+
+def data_version():
+    rows = yield "SELECT to_regclass('dataset_metadata') IS NOT NULL as present", ()
+    version = None
+    if rows[0]['present']:
+        rows = yield "SELECT value FROM dataset_metadata WHERE key = 'data_version'", ()
+        version = rows[0]['value'] if rows else None
+    return version or 'initial'
+
+
+def parse_number(name, value):
+    """Nombre d'un paramètre de requête (zoom, tolerance...) ; ValueError si invalide"""
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError(f"{name} invalide : nombre attendu")
+    if not math.isfinite(number):
+        raise ValueError(f"{name} invalide : nombre attendu")
+    return number
+
+
+def parse_bbox(value):
+    """Emprise "minLon,minLat,maxLon,maxLat" (WGS84) d'un paramètre bbox ; ValueError si invalide"""
+    try:
+        bbox = tuple(float(v) for v in value.split(','))
+    except ValueError:
+        raise ValueError("bbox invalide : 4 nombres attendus (minLon,minLat,maxLon,maxLat)")
+    if len(bbox) != 4:
+        raise ValueError("bbox invalide : 4 nombres attendus (minLon,minLat,maxLon,maxLat)")
+    min_lon, min_lat, max_lon, max_lat = bbox
+    if not (-180 <= min_lon < max_lon <= 180 and -90 <= min_lat < max_lat <= 90):
+        raise ValueError("bbox invalide : emprise hors limites ou vide")
+    return bbox
+
+
+def parse_int(name, value):
+    """Entier d'un paramètre de requête (zone_id, parent_id, year...) ; ValueError si absent ou invalide"""
+    if value is None or not str(value).strip():
+        raise ValueError(f"{name} is required")
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f"{name} invalide : entier attendu")
+    # Colonnes integer de PostgreSQL
+    if not -2 ** 31 <= number < 2 ** 31:
+        raise ValueError(f"{name} invalide : entier hors limites")
+    return number
+
+
+def parse_ids(name, value):
+    """Identifiants "12,15" d'un paramètre de requête ; ValueError si aucun ou invalide"""
+    ids = [parse_int(name, v) for v in (value or '').split(',') if v.strip()]
+    if not ids:
+        raise ValueError(f"{name} is required")
+    return ids
+
+
+_ENVELOPE_SQL = "ST_MakeEnvelope(%s, %s, %s, %s, 4326)"
+
+
+def _zone_filter(level, parent_id, bbox=None):
+    zone_filter = "z.level = %s"
+    params = [level]
+    if parent_id:
+        zone_filter += " AND z.parent_id = %s"
+        params.append(int(parent_id))
+    if bbox:
+        # Zones visibles dans l'emprise (index GiST sur geometry)
+        zone_filter += f" AND ST_Intersects(z.geometry, {_ENVELOPE_SQL})"
+        params.extend(bbox)
+    return zone_filter, params
+
+
+# [lon, lat] d'un point précalculé (centroid, label_point), null s'il n'est pas encore calculé
+_POINT_JSON_SQL = "CASE WHEN {point} IS NOT NULL THEN json_build_array(ST_X({point}), ST_Y({point})) END"
+
+
+def _zone_geometry(bbox=None, clip=False):
+    """Géométrie servie (niveau de détail sinon complète), découpée sur l'emprise si clip"""
+    geometry = "COALESCE(g.geometry, z.geometry)"
+    if bbox and clip:
+        return f"ST_ClipByBox2D({geometry}, {_ENVELOPE_SQL})", list(bbox)
+    return geometry, []
+
+
+# --- CONTOURS ---
+
+def zone_features(level, parent_id, lod, decimals, bbox=None, clip=False):
+    """Zones d'un niveau avec leur géométrie décodée (pour construire la topologie TopoJSON)"""
+    zone_filter, params = _zone_filter(level, parent_id, bbox)
+    geometry, geometry_params = _zone_geometry(bbox, clip)
+    rows = yield f"""
+        SELECT z.id, z.name, z.level, z.parent_id, z.code,
+               ST_AsGeoJSON({geometry}, %s)::json as geometry
+        FROM administrative_zones z
+        LEFT JOIN zone_geometry_lod g ON g.zone_id = z.id AND g.lod = %s
+        WHERE {zone_filter}
+    """, geometry_params + [decimals, lod] + params
+    return [{"id": row['id'], "geometry": row.pop('geometry'), "properties": row} for row in rows]
+
+
+def zones_collection(level, parent_id, lod, decimals, bbox=None, clip=False):
+    """FeatureCollection sérialisée par PostgreSQL, renvoyée telle quelle (texte JSON)"""
+    zone_filter, params = _zone_filter(level, parent_id, bbox)
+    geometry, geometry_params = _zone_geometry(bbox, clip)
+    rows = yield f"""
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(json_agg(json_build_object(
+                'type', 'Feature',
+                'properties', json_build_object(
+                    'id', z.id, 'name', z.name, 'level', z.level, 'parent_id', z.parent_id, 'code', z.code
+                ),
+                'geometry', ST_AsGeoJSON({geometry}, %s)::json
+            )), '[]'::json)
+        )::text as collection
+        FROM administrative_zones z
+        LEFT JOIN zone_geometry_lod g ON g.zone_id = z.id AND g.lod = %s
+        WHERE {zone_filter}
+    """, geometry_params + [decimals, lod] + params
+    return rows[0]['collection']
+
+
+def zones_points(level, parent_id, bbox=None):
+    """FeatureCollection sans contours : point d'étiquette de chaque zone, avec centroïde, emprise et surface"""
+    zone_filter, params = _zone_filter(level, parent_id, bbox)
+    rows = yield f"""
+        SELECT json_build_object(
+            'type', 'FeatureCollection',
+            'features', COALESCE(json_agg(json_build_object(
+                'type', 'Feature',
+                'properties', json_build_object(
+                    'id', z.id, 'name', z.name, 'level', z.level, 'parent_id', z.parent_id, 'code', z.code,
+                    'centroid', {_POINT_JSON_SQL.format(point='z.centroid')},
+                    'bbox', z.bbox, 'area_km2', z.area_km2
+                ),
+                'geometry', ST_AsGeoJSON(z.label_point)::json
+            ) ORDER BY z.id), '[]'::json)
+        )::text as collection
+        FROM administrative_zones z
+        WHERE {zone_filter}
+    """, params
+    return rows[0]['collection']
+
+
+# --- FILTRES ET CARTE ---
+
+def filters(parent_id):
+    if not parent_id:
+        stats_join = "JOIN production_stats ps ON ps.sub_sector_id = ss.id"
+        params = []
+    else:
+        # Le cube a une ligne par sous-secteur présent dans le sous-arbre
+        stats_join = "JOIN production_rollup pr ON pr.sub_sector_id = ss.id AND pr.zone_id = %s AND pr.year = %s"
+        params = [int(parent_id), ALL_YEARS]
+    rows = yield f"""
+        SELECT DISTINCT ss.id, ss.name, ss.color, s.name as category
+        FROM sub_sectors ss
+        JOIN sectors s ON ss.sector_id = s.id
+        {stats_join}
+        ORDER BY s.name, ss.name
+    """, params
+    grouped = {}
+    for row in rows:
+        cat = row['category']
+        if cat not in grouped: grouped[cat] = []
+        grouped[cat].append(row)
+    return grouped
+
+
+def sector_info(sub_sector_id):
+    rows = yield "SELECT ss.name, ss.color, s.name as category FROM sub_sectors ss JOIN sectors s ON ss.sector_id = s.id WHERE ss.id = %s", (sub_sector_id,)
+    return rows[0] if rows else None
+
+
+def _map_zones_sql(sub_sector_id, level, parent_id, lod, bbox=None):
+    # La valeur de chaque zone (sous-arbre compris) est lue directement dans le cube production_rollup
+    zone_filter, params = _zone_filter(level, parent_id, bbox)
+    sql = f"""
+        FROM administrative_zones z
+        LEFT JOIN zone_geometry_lod g ON g.zone_id = z.id AND g.lod = %s
+        LEFT JOIN production_rollup pr ON pr.zone_id = z.id AND pr.sub_sector_id = %s AND pr.year = %s
+        WHERE {zone_filter}
+    """
+    return sql, [lod, sub_sector_id, ALL_YEARS] + params
+
+
+def map_data_geojson(sub_sector_id, level, parent_id, lod, decimals, bbox=None, clip=False):
+    """Corps JSON complet de /api/map/data : features et totaux sérialisés par PostgreSQL"""
+    sector = yield from sector_info(sub_sector_id)
+    zones_sql, params = _map_zones_sql(sub_sector_id, level, parent_id, lod, bbox)
+    geometry, geometry_params = _zone_geometry(bbox, clip)
+    rows = yield f"""
+        SELECT COALESCE(json_agg(json_build_object(
+                   'type', 'Feature',
+                   'properties', json_build_object(
+                       'id', z.id, 'name', z.name, 'level', z.level, 'parent_id', z.parent_id, 'code', z.code,
+                       'value', COALESCE(pr.volume, 0)::float8, 'unit', COALESCE(pr.unit, '')
+                   ),
+                   'geometry', ST_AsGeoJSON({geometry}, %s)::json
+               )), '[]'::json)::text as features,
+               COALESCE(SUM(pr.volume), 0)::float8 as total,
+               COALESCE(MAX(pr.unit), '') as unit
+        {zones_sql}
+    """, geometry_params + [decimals] + params
+    result = rows[0]
+    return (
+        '{"geojson":{"type":"FeatureCollection","features":' + result['features'] + '},'
+        '"stats":' + json.dumps({"total": result['total'], "unit": result['unit']}, ensure_ascii=False) + ','
+        '"sector":' + json.dumps(sector, ensure_ascii=False) + '}'
+    )
+
+
+def map_values(sub_sector_id, level, parent_id, lod, bbox=None):
+    """Valeurs de la filière par zone (sans géométrie), pour le format TopoJSON"""
+    sector = yield from sector_info(sub_sector_id)
+    zones_sql, params = _map_zones_sql(sub_sector_id, level, parent_id, lod, bbox)
+    rows = yield f"""
+        SELECT z.id, z.name, z.level, z.parent_id, z.code,
+               COALESCE(pr.volume, 0)::float8 as value, COALESCE(pr.unit, '') as unit
+        {zones_sql}
+    """, params
+    return sector, {row['id']: row for row in rows}
+
+
+def map_data_topojson(topology, sector, values):
+    """Corps de /api/map/data en TopoJSON : valeurs greffées sur une copie de la topologie partagée"""
+    collection = topology['objects']['zones']
+    geometries = [
+        {**geom, "properties": values.get(geom.get('id'), geom['properties'])}
+        for geom in collection['geometries']
+    ]
+    units = [p['unit'] for p in values.values() if p['unit']]
+    return {
+        "topojson": {**topology, "objects": {"zones": {**collection, "geometries": geometries}}},
+        "stats": { "total": sum(p['value'] for p in values.values()), "unit": units[-1] if units else "" },
+        "sector": sector
+    }
+
+
+# --- SECTIONS DU PANNEAU DROIT ---
+# Chaque section lit le cube production_rollup. Les routes individuelles et
+# /api/zone/panel partagent ce code ; /api/zone/panel lit en plus toutes les
+# zones et sections demandées sur une seule connexion.
+
+def zone_stats_section(zone_id, **_):
+    rows = yield """
+        SELECT ss.name as sector, s.name as category, pr.volume, pr.unit
+        FROM production_rollup pr
+        JOIN sub_sectors ss ON pr.sub_sector_id = ss.id
+        JOIN sectors s ON ss.sector_id = s.id
+        WHERE pr.zone_id = %s AND pr.year = %s
+        ORDER BY pr.volume DESC
+    """, (int(zone_id), ALL_YEARS)
+    return rows
+
+
+def evolution_section(zone_id, **_):
+    """Evolution temporelle avec métadonnées de catégorie"""
+    # On récupère aussi s.name (Catégorie)
+    rows = yield """
+        SELECT pr.year, ss.name as sector, s.name as category, pr.volume
+        FROM production_rollup pr
+        JOIN sub_sectors ss ON pr.sub_sector_id = ss.id
+        JOIN sectors s ON ss.sector_id = s.id -- Jointure ajoutée
+        WHERE pr.zone_id = %s AND pr.year <> %s
+        ORDER BY pr.year ASC
+    """, (int(zone_id), ALL_YEARS)
+
+    data_by_year = {}
+    sectors = set()
+    # Dictionnaire pour mapper Filière -> Catégorie
+    # Ex: {"Cacao": "Agriculture", "Bovins": "Elevage"}
+    categories_map = {}
+
+    for row in rows:
+        year = int(row['year'])
+        if year not in data_by_year: data_by_year[year] = {"year": year}
+
+        sector_name = row['sector']
+        data_by_year[year][sector_name] = float(row['volume'])
+
+        sectors.add(sector_name)
+        categories_map[sector_name] = row['category'].upper() # On normalise en MAJ
+
+    sorted_data = sorted(list(data_by_year.values()), key=lambda x: x['year'])
+
+    return {
+        "data": sorted_data,
+        "sectors": list(sectors),
+        "categories": categories_map # On renvoie ce mapping au frontend
+    }
+
+
+def comparison_section(zone_id, sub_sector_id=None, year=None, **_):
+    """Comparaison des enfants directs (ex: Départements d'une Région)"""
+    rollup_year = int(year) if year else ALL_YEARS
+    # Une seule passe : la filière comparée (celle demandée, sinon le top produit de la
+    # zone parente) est résolue une fois, puis tous les enfants directs sont lus dans le cube.
+    rows = yield """
+        WITH compared AS (
+            SELECT COALESCE(%s::int, (
+                SELECT sub_sector_id FROM production_rollup
+                WHERE zone_id = %s AND year = %s
+                ORDER BY volume DESC LIMIT 1
+            )) AS sub_sector_id
+        )
+        SELECT c.id, c.name, COALESCE(pr.volume, 0)::float8 as value, pr.unit
+        FROM compared cmp
+        JOIN administrative_zones c ON c.parent_id = %s
+        LEFT JOIN production_rollup pr
+            ON pr.zone_id = c.id AND pr.year = %s AND pr.sub_sector_id = cmp.sub_sector_id
+        WHERE cmp.sub_sector_id IS NOT NULL
+        ORDER BY c.id
+    """, (int(sub_sector_id) if sub_sector_id else None, int(zone_id), rollup_year, int(zone_id), rollup_year)
+    return rows
+
+
+def global_section(zone_id, year=None, **_):
+    """Stats globales d'une zone (Nom, TOUTES les productions, Volume total)"""
+    # 1. Info Zone
+    rows = yield "SELECT name, level FROM administrative_zones WHERE id = %s", (int(zone_id),)
+    zone_info = rows[0] if rows else None
+
+    # Lecture directe du cube (cumul toutes années si pas d'année demandée)
+    rollup_year = int(year) if year else ALL_YEARS
+
+    # 2. TOUTES les productions et les totaux en une seule agrégation :
+    # une ligne par produit + une ligne de total (GROUPING SETS)
+    all_products = yield """
+        SELECT GROUPING(ss.name) = 1 as is_total, ss.name,
+               SUM(pr.volume) as volume, MAX(pr.unit) as unit,
+               SUM(pr.surface_area) as surface_area,
+               SUM(pr.producer_count) as producer_count,
+               ROUND(SUM(pr.volume) / NULLIF(SUM(pr.surface_area), 0), 2) as yield,
+               ROUND(SUM(pr.average_price * pr.volume) / NULLIF(SUM(pr.volume), 0), 2) as average_price
+        FROM production_rollup pr
+        JOIN sub_sectors ss ON pr.sub_sector_id = ss.id
+        WHERE pr.zone_id = %s AND pr.year = %s
+        GROUP BY GROUPING SETS ((ss.name), ())
+        ORDER BY is_total, volume DESC
+    """, (int(zone_id), rollup_year)
+    # La ligne de total arrive en dernier (ORDER BY is_total)
+    totals = all_products.pop() if all_products and all_products[-1]['is_total'] else None
+    for product in all_products: product.pop('is_total')
+
+    return {
+        "zone_name": zone_info['name'] if zone_info else 'N/A',
+        "zone_level": zone_info['level'] if zone_info else 'N/A',
+        "top_products": all_products, # On garde la clé "top_products" pour pas casser le frontend, mais elle contient TOUT
+        "total_volume": float(totals['volume']) if totals and totals['volume'] else 0,
+        "total_surface": float(totals['surface_area']) if totals and totals['surface_area'] else 0,
+        "total_producers": int(totals['producer_count']) if totals and totals['producer_count'] else 0
+    }
+
+
+PANEL_SECTIONS = {
+    "stats": zone_stats_section,
+    "evolution": evolution_section,
+    "comparison": comparison_section,
+    "global": global_section,
+}
+
+
+def zone_panel(zone_ids, sections, **params):
+    """Sections demandées du panneau droit, pour chaque zone"""
+    panel = {}
+    for zone_id in zone_ids:
+        zone_id = int(zone_id)
+        panel[zone_id] = {}
+        for name in sections:
+            panel[zone_id][name] = yield from PANEL_SECTIONS[name](zone_id, **params)
+    return panel
+
+
+# --- RECHERCHE ET TUILES ---
+
+def search(term):
+    # Recherche insensible à la casse et aux accents ("Ngaoundere" trouve "Ngaoundéré"),
+    # servie par l'index trigramme sur normalize_zone_name(name).
+    # Classement : début de nom, similarité, puis niveau (régions d'abord).
+    # On exclut le niveau PAYS car inutile à chercher
+    # Le point d'étiquette et l'emprise permettent de centrer la carte sans télécharger le contour
+    # Le terme n'est pas échappé pour LIKE : normalize_zone_name (derived_tables.py) ne garde
+    # que [a-z0-9] et des espaces, les caractères spéciaux de LIKE (%, _, \) sont donc retirés.
+    # Un terme sans lettre ni chiffre ("%%", "__") devient vide et ne renvoie rien.
+    rows = yield f"""
+        WITH q AS (SELECT normalize_zone_name(%s) AS term)
+        SELECT z.id, z.name, z.level, z.parent_id,
+               round(similarity(normalize_zone_name(z.name), q.term)::numeric, 3) as score,
+               {_POINT_JSON_SQL.format(point='z.label_point')} as label_point, z.bbox,
+               (
+                   SELECT json_agg(json_build_object('id', a.id, 'name', a.name, 'level', a.level) ORDER BY zc.depth DESC)
+                   FROM zone_closure zc JOIN administrative_zones a ON a.id = zc.ancestor_id
+                   WHERE zc.descendant_id = z.id AND zc.depth > 0
+               ) as parents
+        FROM administrative_zones z, q
+        WHERE z.level != 'COUNTRY' AND q.term <> ''
+          AND (normalize_zone_name(z.name) LIKE '%%' || q.term || '%%' OR normalize_zone_name(z.name) %% q.term)
+        ORDER BY starts_with(normalize_zone_name(z.name), q.term) DESC,
+                 score DESC,
+                 array_position(ARRAY['REGION', 'DEPARTEMENT', 'ARRONDISSEMENT'], z.level::text),
+                 z.name ASC
+        LIMIT 10
+    """, (term,)
+    return rows
+
+
+def zone_geometries():
+    """Contours complets de toutes les zones (WKB), pour l'index de localisation (geo_index.py)"""
+    rows = yield """
+        SELECT id, name, level, code, parent_id, ST_AsBinary(geometry) AS wkb
+        FROM administrative_zones
+        WHERE geometry IS NOT NULL
+        ORDER BY id
+    """, ()
+    return rows
+
+
+def vector_tile(level, z, x, y, lod, sub_sector_id, layer_name):
+    """Tuile Mapbox Vector Tile (octets) des zones d'un niveau"""
+    # Découpage et quantification par ST_AsMVTGeom, à partir de la géométrie simplifiée du zoom
+    rows = yield """
+        WITH bounds AS (
+            SELECT ST_TileEnvelope(%s, %s, %s) AS env,
+                   ST_Transform(ST_TileEnvelope(%s, %s, %s), 4326) AS env_4326
+        ),
+        features AS (
+            SELECT ST_AsMVTGeom(ST_Transform(COALESCE(g.geometry, z.geometry), 3857), b.env, 4096, 64, true) AS geom,
+                   z.id, z.name, z.level, z.parent_id, z.code,
+                   pr.volume::float8 AS value, pr.unit
+            FROM administrative_zones z
+            CROSS JOIN bounds b
+            LEFT JOIN zone_geometry_lod g ON g.zone_id = z.id AND g.lod = %s
+            LEFT JOIN production_rollup pr ON pr.zone_id = z.id AND pr.sub_sector_id = %s AND pr.year = %s
+            WHERE z.level = %s AND z.geometry && b.env_4326
+        )
+        SELECT ST_AsMVT(features, %s, 4096, 'geom') as tile FROM features WHERE geom IS NOT NULL
+    """, (z, x, y, z, x, y, lod, sub_sector_id, ALL_YEARS, level, layer_name)
+    return bytes(rows[0]['tile'] or b'')
@@ -1,7 +1,14 @@
-import pandas as pd
+import argparse
+import csv
+import json
+import time
 from sqlalchemy import create_engine, text
 import os
 from dotenv import load_dotenv
+from derived_tables import (
+    rebuild_zone_closure, refresh_production_rollup, bump_data_version, ensure_zone_search_index,
+    set_dataset_metadata
+)
 
 load_dotenv()
 
@@ -99,7 +106,8 @@ def update_table_structure():
             ("yield", "numeric(10,2)"),
             ("producer_count", "integer"),
             ("average_price", "numeric(15,2)"),
-            ("year", "integer DEFAULT 2023")
+            ("year", "integer DEFAULT 2023"),
+            ("content_hash", "char(32)")
         ]
 
         for col_name, col_type in columns_to_add:
@@ -118,7 +126,197 @@ def update_table_structure():
         conn.commit()
         print("✅ Structure de la table vérifiée.")
 
-def seed_database():
+# Colonnes du CSV de production, chargées telles quelles dans production_staging par COPY
+STAGING_COLUMNS = {
+    "year": "INTEGER", "pcode": "VARCHAR(50)", "zone_name": "TEXT", "level": "VARCHAR(20)",
+    "parent_pcode": "VARCHAR(50)", "sector": "VARCHAR(100)", "sub_sector": "VARCHAR(100)",
+    "volume": "NUMERIC", "unit": "VARCHAR(20)", "surface_area": "NUMERIC", "yield": "NUMERIC",
+    "producer_count": "NUMERIC", "average_price": "NUMERIC", "description": "TEXT"
+}
+
+# Taille des blocs lus dans le CSV et envoyés au serveur par COPY
+COPY_CHUNK_BYTES = 1024 * 1024
+
+def load_production_staging(conn, csv_path):
+    """Envoie le CSV au serveur par COPY, par blocs, dans la table temporaire production_staging.
+
+    Le fichier n'est jamais chargé en mémoire : c'est PostgreSQL qui découpe et convertit
+    les lignes. Les valeurs vides deviennent NULL. La table est propre à la session et
+    disparaît au commit, comme zone_staging dans ingest_data.py : deux chargements simultanés
+    ne se mélangent pas et aucune copie du CSV ne reste en base. Renvoie le nombre de lignes chargées.
+    """
+    columns = ",\n            ".join(f"{name} {sql_type}" for name, sql_type in STAGING_COLUMNS.items())
+    conn.execute(text(f"""
+        -- Ancienne table permanente (versions précédentes) : elle garderait une copie du dernier CSV
+        DROP TABLE IF EXISTS production_staging;
+        CREATE TEMP TABLE production_staging (
+            line BIGINT GENERATED ALWAYS AS IDENTITY,
+            {columns}
+        ) ON COMMIT DROP;
+    """))
+    with open(csv_path, encoding='utf-8', newline='') as f:
+        header = next(csv.reader([f.readline()]))
+        unknown = [c for c in header if c not in STAGING_COLUMNS]
+        if unknown:
+            raise ValueError(f"Colonnes inconnues dans {csv_path} : {', '.join(unknown)}")
+        cur = conn.connection.cursor()
+        try:
+            cur.copy_expert(
+                f"COPY production_staging ({', '.join(header)}) FROM STDIN WITH (FORMAT csv)",
+                f, size=COPY_CHUNK_BYTES
+            )
+            rows = cur.rowcount
+        finally:
+            cur.close()
+    conn.execute(text("ANALYZE production_staging"))
+    return rows
+
+def sync_zones(conn):
+    """Codes, niveaux et parents des zones du CSV reportés sur administrative_zones en une requête.
+
+    Les zones distinctes de production_staging sont copiées dans une table temporaire, puis
+    associées aux zones existantes : par code d'abord, sinon par nom normalisé
+    (normalize_zone_name, sans accents ni casse) en préférant la zone dont le parent et le
+    niveau correspondent aussi.
+    Renvoie (nombre de zones modifiées, zones du CSV sans correspondance).
+    """
+    conn.execute(text("""
+        CREATE TEMP TABLE zone_sync_staging ON COMMIT DROP AS
+        SELECT DISTINCT ON (pcode)
+               pcode, zone_name,
+               COALESCE(CAST(:name_mapping AS jsonb) ->> zone_name, zone_name) AS mapped_name,
+               level, NULLIF(parent_pcode, '') AS parent_pcode
+        FROM production_staging
+        WHERE pcode IS NOT NULL AND zone_name IS NOT NULL
+        ORDER BY pcode, line;
+        ALTER TABLE zone_sync_staging ADD PRIMARY KEY (pcode);
+    """), {"name_mapping": json.dumps(NAME_MAPPING)})
+
+    updated = conn.execute(text("""
+        WITH staged AS (
+            SELECT s.*, normalize_zone_name(s.zone_name) AS name_key, normalize_zone_name(s.mapped_name) AS mapped_key,
+                   normalize_zone_name(p.zone_name) AS parent_key, normalize_zone_name(p.mapped_name) AS parent_mapped_key
+            FROM zone_sync_staging s
+            LEFT JOIN zone_sync_staging p ON p.pcode = s.parent_pcode
+        ),
+        zone_keys AS (
+            SELECT id, code, level::text AS level, parent_id, normalize_zone_name(name) AS name_key
+            FROM administrative_zones
+        ),
+        pairs AS (
+            -- Jointures d'égalité (hachage) sur le code et sur chacune des deux clés de nom
+            SELECT s.pcode, zk.id AS zone_id FROM staged s JOIN zone_keys zk ON zk.code = s.pcode
+            UNION
+            SELECT s.pcode, zk.id FROM staged s
+            CROSS JOIN LATERAL (VALUES (s.name_key), (s.mapped_key)) k(name_key)
+            JOIN zone_keys zk ON zk.name_key = k.name_key
+        ),
+        candidates AS (
+            -- Rang : code identique, puis parent identique, puis niveau identique
+            SELECT s.pcode, z.id AS zone_id,
+                   (z.code IS DISTINCT FROM s.pcode)::int * 4
+                   + (zp.name_key IS DISTINCT FROM s.parent_key AND zp.name_key IS DISTINCT FROM s.parent_mapped_key)::int * 2
+                   + (z.level IS DISTINCT FROM s.level)::int AS rank
+            FROM pairs
+            JOIN staged s ON s.pcode = pairs.pcode
+            JOIN zone_keys z ON z.id = pairs.zone_id
+            LEFT JOIN zone_keys zp ON zp.id = z.parent_id
+        ),
+        best_per_pcode AS (
+            SELECT DISTINCT ON (pcode) pcode, zone_id, rank FROM candidates ORDER BY pcode, rank, zone_id
+        ),
+        matches AS (
+            -- Une zone existante ne reçoit qu'un seul code (le mieux classé)
+            SELECT DISTINCT ON (zone_id) pcode, zone_id FROM best_per_pcode ORDER BY zone_id, rank, pcode
+        )
+        UPDATE administrative_zones z
+        SET code = n.code, level = n.level, parent_id = n.parent_id
+        FROM (
+            SELECT m.zone_id, s.pcode AS code, s.level,
+                   CASE WHEN s.parent_pcode IS NULL THEN NULL ELSE COALESCE(pm.zone_id, cur.parent_id) END AS parent_id
+            FROM matches m
+            JOIN zone_sync_staging s ON s.pcode = m.pcode
+            JOIN administrative_zones cur ON cur.id = m.zone_id
+            LEFT JOIN matches pm ON pm.pcode = s.parent_pcode
+        ) n
+        -- Les zones déjà à jour ne sont pas réécrites
+        WHERE z.id = n.zone_id AND (z.code, z.level::text, z.parent_id) IS DISTINCT FROM (n.code, n.level, n.parent_id)
+    """)).rowcount
+
+    unmatched = conn.execute(text("""
+        SELECT s.pcode, s.zone_name, s.level FROM zone_sync_staging s
+        WHERE NOT EXISTS (SELECT 1 FROM administrative_zones z WHERE z.code = s.pcode)
+        ORDER BY s.pcode
+    """)).fetchall()
+    return updated, unmatched
+
+# Lignes du CSV prêtes à fusionner : une par clé (la dernière l'emporte), avec l'empreinte
+# md5 de leur contenu, comparée à production_stats.content_hash en mode incrémental.
+INCOMING_STATS_SQL = """
+    SELECT DISTINCT ON (ss.id, st.pcode, st.year)
+           ss.id AS sub_sector_id, st.pcode AS zone_code, st.year,
+           st.volume, st.unit, COALESCE(st.description, '') AS description,
+           COALESCE(st.surface_area, 0) AS surface_area, COALESCE(st.yield, 0) AS yield,
+           COALESCE(st.producer_count, 0) AS producer_count, COALESCE(st.average_price, 0) AS average_price,
+           md5(concat_ws('|', st.volume, st.unit, COALESCE(st.description, ''), COALESCE(st.surface_area, 0),
+                         COALESCE(st.yield, 0), COALESCE(st.producer_count, 0), COALESCE(st.average_price, 0))) AS content_hash
+    FROM production_staging st
+    JOIN sectors s ON s.name = st.sector
+    JOIN sub_sectors ss ON ss.sector_id = s.id AND ss.name = st.sub_sector
+    ORDER BY ss.id, st.pcode, st.year, st.line DESC
+"""
+
+def merge_production_stats(conn, incremental=False):
+    """Fusionne production_staging dans production_stats.
+
+    En mode incrémental, seules les lignes nouvelles ou dont l'empreinte a changé sont
+    écrites, et celles absentes du CSV sont supprimées ; les ids ne bougent pas.
+    Renvoie {"inserted", "updated", "deleted"}.
+    """
+    changed_filter = ""
+    if incremental:
+        changed_filter = """
+            LEFT JOIN production_stats p
+              ON p.sub_sector_id = i.sub_sector_id AND p.zone_code = i.zone_code AND p.year = i.year
+            WHERE p.content_hash IS DISTINCT FROM i.content_hash
+        """
+    flags = conn.execute(text(f"""
+        INSERT INTO production_stats (
+            sub_sector_id, zone_code, volume, unit, description, year,
+            surface_area, yield, producer_count, average_price, content_hash
+        )
+        SELECT i.sub_sector_id, i.zone_code, i.volume, i.unit, i.description, i.year,
+               i.surface_area, i.yield, i.producer_count, i.average_price, i.content_hash
+        FROM ({INCOMING_STATS_SQL}) i
+        {changed_filter}
+        ON CONFLICT (sub_sector_id, zone_code, year)
+        DO UPDATE SET
+            volume = EXCLUDED.volume,
+            unit = EXCLUDED.unit,
+            description = EXCLUDED.description,
+            surface_area = EXCLUDED.surface_area,
+            yield = EXCLUDED.yield,
+            producer_count = EXCLUDED.producer_count,
+            average_price = EXCLUDED.average_price,
+            content_hash = EXCLUDED.content_hash
+        RETURNING (xmax = 0) AS inserted
+    """)).scalars().all()
+    inserted = sum(flags)
+
+    deleted = 0
+    if incremental:
+        deleted = conn.execute(text("""
+            DELETE FROM production_stats p
+            WHERE NOT EXISTS (
+                SELECT 1 FROM production_staging st
+                JOIN sectors s ON s.name = st.sector
+                JOIN sub_sectors ss ON ss.sector_id = s.id AND ss.name = st.sub_sector
+                WHERE ss.id = p.sub_sector_id AND st.pcode = p.zone_code AND st.year = p.year
+            )
+        """)).rowcount
+    return {"inserted": inserted, "updated": len(flags) - inserted, "deleted": deleted}
+
+def seed_database(incremental=False):
     # D'abord, on met à jour la structure
     update_table_structure()
 
@@ -127,126 +325,82 @@ def seed_database():
         print(f"❌ Erreur: Fichier {csv_path} introuvable. Lancez 'python3 generate_full_data.py' d'abord.")
         return
 
-    print("Lecture du fichier CSV...")
-    df = pd.read_csv(csv_path, encoding='utf-8')
-
-    # Remplacer les valeurs NaN
-    df = df.fillna({
-        'surface_area': 0, 'yield': 0, 'producer_count': 0,
-        'average_price': 0, 'description': '', 'parent_pcode': ''
-    })
-
     with engine.connect() as conn:
-        print("--- 1. Nettoyage des tables de statistiques ---")
-        conn.execute(text("TRUNCATE production_stats, sub_sectors, sectors RESTART IDENTITY CASCADE;"))
-
-        print("--- 2. Synchronisation des Zones Géographiques ---")
-
-        processed_zones = set()
-
-        # Récupération des IDs existants
-        existing_zones = pd.read_sql("SELECT code, id FROM administrative_zones", conn)
-        zone_id_map = dict(zip(existing_zones['code'], existing_zones['id']))
-
-        # On parcourt le CSV pour mettre à jour les zones
-        for _, row in df.iterrows():
-            pcode = row['pcode']
-            if pcode in processed_zones: continue
-
-            zone_name = row['zone_name']
-            level = row['level']
-            parent_pcode = row['parent_pcode']
-            db_name = NAME_MAPPING.get(zone_name, zone_name)
-
-            # Trouver l'ID du parent
-            parent_id = None
-            if parent_pcode and parent_pcode in zone_id_map:
-                parent_id = zone_id_map[parent_pcode]
-
-            # Mise à jour de la zone (Code, Level, Parent)
-            res = conn.execute(text("""
-                UPDATE administrative_zones
-                SET code = :code, level = :level, parent_id = :pid
-                WHERE code = :code OR name ILIKE :name OR name ILIKE :mapped_name
-            """), {
-                "code": pcode,
-                "level": level,
-                "pid": str(parent_id) if parent_id else None,
-                "name": zone_name,
-                "mapped_name": db_name
-            })
-
-            processed_zones.add(pcode)
-
-        print("--- 3. Insertion des Secteurs & Sous-Secteurs ---")
-        unique_sectors = df['sector'].unique()
-        sector_map = {}
-
-        for sec_name in unique_sectors:
-            res = conn.execute(text("INSERT INTO sectors (name) VALUES (:name) ON CONFLICT (name) DO UPDATE SET name=EXCLUDED.name RETURNING id"), {"name": sec_name})
-            sector_map[sec_name] = res.fetchone()[0]
-
-        unique_subs = df[['sector', 'sub_sector']].drop_duplicates()
-        sub_sector_map = {}
-
-        for _, row in unique_subs.iterrows():
-            sec_name = row['sector']
-            sub_name = row['sub_sector']
-            color = COLORS.get(sub_name, '#7F8C8D')
-
-            res = conn.execute(
-                text("""
-                    INSERT INTO sub_sectors (sector_id, name, color)
-                    VALUES (:sid, :name, :color)
-                    ON CONFLICT (sector_id, name) DO UPDATE SET color=EXCLUDED.color
-                    RETURNING id
-                """),
-                {"sid": sector_map[sec_name], "name": sub_name, "color": color}
-            )
-            sub_sector_map[(sec_name, sub_name)] = res.fetchone()[0]
-
-        print(f"--- 4. Insertion des Statistiques ({len(df)} lignes) ---")
-
-        data_to_insert = []
-        for _, row in df.iterrows():
-            sub_id = sub_sector_map.get((row['sector'], row['sub_sector']))
-            if sub_id:
-                data_to_insert.append({
-                    "sid": sub_id,
-                    "code": row['pcode'],
-                    "vol": row['volume'],
-                    "unit": row['unit'],
-                    "desc": row['description'],
-                    "year": row['year'],
-                    "surf": row['surface_area'],
-                    "yield": row['yield'],
-                    "prod_count": row['producer_count'],
-                    "price": row['average_price']
-                })
-
-        if data_to_insert:
-            # Insertion par lot (batch)
-            conn.execute(
-                text("""
-                    INSERT INTO production_stats (
-                        sub_sector_id, zone_code, volume, unit, description, year,
-                        surface_area, yield, producer_count, average_price
-                    )
-                    VALUES (:sid, :code, :vol, :unit, :desc, :year, :surf, :yield, :prod_count, :price)
-                    ON CONFLICT (sub_sector_id, zone_code, year)
-                    DO UPDATE SET
-                        volume = EXCLUDED.volume,
-                        description = EXCLUDED.description,
-                        surface_area = EXCLUDED.surface_area,
-                        yield = EXCLUDED.yield,
-                        producer_count = EXCLUDED.producer_count,
-                        average_price = EXCLUDED.average_price
-                """),
-                data_to_insert
-            )
+        if incremental:
+            # Les ids des secteurs et sous-secteurs (utilisés dans les URL des clients) sont conservés
+            print("--- 1. Mode incrémental : pas de nettoyage ---")
+        else:
+            print("--- 1. Nettoyage des tables de statistiques ---")
+            conn.execute(text("TRUNCATE production_stats, sub_sectors, sectors RESTART IDENTITY CASCADE;"))
+
+        print("--- 2. Chargement du CSV (COPY) ---")
+        start = time.perf_counter()
+        rows = load_production_staging(conn, csv_path)
+        elapsed = time.perf_counter() - start
+        print(f"{rows} lignes chargées en {elapsed:.2f}s ({rows / max(elapsed, 1e-6):,.0f} lignes/s).")
+
+        print("--- 3. Synchronisation des Zones Géographiques ---")
+
+        ensure_zone_search_index(conn)
+        updated, unmatched = sync_zones(conn)
+        print(f"{updated} zones modifiées.")
+        if unmatched:
+            print(f"⚠️ {len(unmatched)} zones du CSV sans correspondance dans administrative_zones :")
+            for pcode, zone_name, level in unmatched[:20]:
+                print(f"   - {pcode} {zone_name} ({level})")
+            if len(unmatched) > 20:
+                print(f"   ... et {len(unmatched) - 20} autres")
+
+        print("--- 4. Insertion des Secteurs & Sous-Secteurs ---")
+        catalog_changes = conn.execute(text("""
+            INSERT INTO sectors (name)
+            SELECT DISTINCT sector FROM production_staging WHERE sector IS NOT NULL
+            ON CONFLICT (name) DO NOTHING
+        """)).rowcount
+        catalog_changes += conn.execute(text("""
+            INSERT INTO sub_sectors (sector_id, name, color)
+            SELECT DISTINCT s.id, st.sub_sector, COALESCE(CAST(:colors AS jsonb) ->> st.sub_sector, '#7F8C8D')
+            FROM production_staging st
+            JOIN sectors s ON s.name = st.sector
+            WHERE st.sub_sector IS NOT NULL
+            ON CONFLICT (sector_id, name) DO UPDATE SET color=EXCLUDED.color
+            WHERE sub_sectors.color IS DISTINCT FROM EXCLUDED.color
+        """), {"colors": json.dumps(COLORS)}).rowcount
+
+        print("--- 5. Fusion des Statistiques ---")
+        start = time.perf_counter()
+        changes = merge_production_stats(conn, incremental=incremental)
+        elapsed = time.perf_counter() - start
+        written = changes["inserted"] + changes["updated"]
+        print(f"{changes['inserted']} ajoutées, {changes['updated']} modifiées, {changes['deleted']} supprimées "
+              f"en {elapsed:.2f}s ({written / max(elapsed, 1e-6):,.0f} lignes/s).")
+
+        # Nombre de lignes réellement modifiées (statistiques, filières, zones), relu par les caches en aval
+        change_count = written + changes["deleted"] + catalog_changes + updated
+        set_dataset_metadata(conn, 'last_change_count', change_count)
+        if incremental and change_count == 0:
+            conn.commit()
+            print("✅ Aucun changement : tables dérivées et version des données conservées.")
+            return
+
+        # Les codes et parents des zones ont pu changer à l'étape 3
+        print("--- 6. Table de fermeture des zones ---")
+        pairs = rebuild_zone_closure(conn)
+        print(f"zone_closure : {pairs} couples ancêtre/descendant.")
+
+        print("--- 7. Rafraîchissement du cube production_rollup ---")
+        cells = refresh_production_rollup(conn)
+        print(f"production_rollup : {cells} cellules.")
+
+        # Invalide les caches de l'api
+        version = bump_data_version(conn)
+        print(f"Version des données : {version}")
 
         conn.commit()
         print(f"✅ Terminé ! Base de données peuplée avec succès.")
 
 if __name__ == "__main__":
-    seed_database()
+    parser = argparse.ArgumentParser(description="Charge data/production_data.csv dans la base")
+    parser.add_argument('--incremental', action='store_true',
+                        help="n'écrit que les différences avec la base (ids des filières conservés)")
+    seed_database(incremental=parser.parse_args().incremental)
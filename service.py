@@ -0,0 +1,217 @@
+"""Logique de l'api commune à app.py (Flask) et asgi_app.py (Starlette), sans dépendance au framework.
+
+Caches et version des données, clés de cache et ETags, négociation de l'encodage,
+topologies et index de localisation, validation des paramètres de requête. Les deux
+points d'entrée n'y ajoutent que l'accès base (run_sync / run_async), leurs verrous
+(threading / asyncio) et la construction des réponses HTTP.
+"""
+import os
+import json
+import time
+import logging
+
+from cache import LRUCache, normalized_cache_key, response_etag, variant_etag
+from derived_tables import pick_geometry_lod
+from geo_index import ZoneLocator, read_points
+from topology import build_topology
+import queries
+
+logger = logging.getLogger("service")
+
+ZONE_LEVELS = ('COUNTRY', 'REGION', 'DEPARTEMENT', 'ARRONDISSEMENT')
+
+# Cache-Control des réponses de lecture (les données ne changent qu'au seed / à l'ingestion)
+CACHE_CONTROL = 'public, max-age=3600'
+
+# Réponses JSON déjà encodées des routes de lecture, clé = version/route/paramètres triés
+response_cache = LRUCache(
+    max_entries=int(os.getenv('RESPONSE_CACHE_ENTRIES', '2048')),
+    max_bytes=int(os.getenv('RESPONSE_CACHE_MB', '256')) * 1024 * 1024
+)
+
+# Tuiles vectorielles déjà calculées, clé = version/couche/z/x/y + filière
+tile_cache = LRUCache(
+    max_entries=int(os.getenv('TILE_CACHE_ENTRIES', '4096')),
+    max_bytes=int(os.getenv('TILE_CACHE_MB', '64')) * 1024 * 1024
+)
+
+# Topologies TopoJSON déjà construites, clé = version/niveau/parent/lod/emprise
+topology_cache = LRUCache(
+    max_entries=int(os.getenv('TOPOLOGY_CACHE_ENTRIES', '256')),
+    max_bytes=int(os.getenv('TOPOLOGY_CACHE_MB', '128')) * 1024 * 1024
+)
+
+# Nombre maximum de points par requête POST /api/gis/locate
+LOCATE_MAX_POINTS = int(os.getenv('LOCATE_MAX_POINTS', '50000'))
+
+
+# --- VERSION DES DONNÉES ---
+
+class DataVersion:
+    """Version du jeu de données (dataset_metadata), relue au plus toutes les `check_seconds`.
+
+    Le point d'entrée relit la version sous son propre verrou quand `fresh()` est faux,
+    puis la passe à `update`, qui vide les caches si seed/ingest l'ont changée.
+    """
+
+    def __init__(self, caches, check_seconds):
+        self.caches = caches
+        self.check_seconds = check_seconds
+        self.value = None
+        self.checked_at = 0.0
+
+    def fresh(self):
+        return time.monotonic() - self.checked_at < self.check_seconds
+
+    def update(self, version):
+        if version != self.value:
+            if self.value is not None:
+                logger.info(f"Nouvelle version des données ({version}), caches vidés")
+            for cache in self.caches:
+                cache.clear()
+        self.value = version
+        self.checked_at = time.monotonic()
+        return version
+
+
+data_version = DataVersion(
+    (response_cache, tile_cache, topology_cache),
+    float(os.getenv('DATA_VERSION_CHECK_SECONDS', '5'))
+)
+
+
+def cache_stats(version):
+    """Corps de /api/health/cache"""
+    return {
+        "data_version": version,
+        "responses": response_cache.stats(),
+        "tiles": tile_cache.stats(),
+        "topologies": topology_cache.stats()
+    }
+
+
+# --- CLÉS DE CACHE, ETAGS, ENCODAGE ---
+
+def request_keys(version, path, args):
+    """(clé du cache de réponses, ETag) d'une requête : version + route + paramètres normalisés"""
+    cache_key = normalized_cache_key(path, args)
+    return f"{version}|{cache_key}", response_etag(version, cache_key)
+
+
+def negotiate_encoding(variants, accepts):
+    """Meilleur encodage disponible accepté par le client (br, puis gzip, sinon brut)"""
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepts(encoding):
+            return encoding
+    return 'identity'
+
+
+def negotiated_etag(etag, variants, accepts):
+    """ETag de la représentation que le client recevrait (à comparer à If-None-Match)"""
+    return variant_etag(etag, negotiate_encoding(variants, accepts))
+
+
+def tile_key(version, level, z, x, y, sub_sector_id):
+    return f"{version}|{level}/{z}/{x}/{y}?sector_id={sub_sector_id}"
+
+
+# --- TOPOLOGIES ET INDEX DE LOCALISATION ---
+
+def topology_key(version, level, parent_id, lod, bbox=None, clip=False):
+    return f"{version}|{level}|{parent_id}|{lod}|{bbox}|{clip}"
+
+
+def cache_topology(key, features):
+    """Topologie TopoJSON (arcs partagés, coordonnées quantifiées) des features, mise en cache"""
+    topology = build_topology(features)
+    topology_cache.set(key, topology, size=len(json.dumps(topology)))
+    return topology
+
+
+class LocatorSlot:
+    """Index de localisation inverse (/api/gis/locate), reconstruit quand la version des données change"""
+
+    def __init__(self):
+        self.version = None
+        self.index = None
+
+    def get(self, version):
+        return self.index if self.version == version else None
+
+    def build(self, version, rows):
+        """STRtree des contours (ZoneLocator) à partir des lignes de queries.zone_geometries()"""
+        index = ZoneLocator(rows)
+        logger.info(f"Index de localisation : {len(index)} zones (version {version})")
+        self.version, self.index = version, index
+        return index
+
+
+zone_locator = LocatorSlot()
+
+
+def query_point(lat, lon):
+    """(ids, lats, lons) du point d'un GET /api/gis/locate?lat=&lon= ; ValueError si absent ou invalide"""
+    if not (lat and lon):
+        raise ValueError("Paramètres lat et lon requis")
+    return read_points(json.dumps({"lat": lat, "lon": lon}), None, 1)
+
+
+def locate_summary(results):
+    """Corps d'un POST /api/gis/locate"""
+    return {
+        "count": len(results),
+        "matched": sum(1 for r in results if r["zone"]),
+        "results": results
+    }
+
+
+# --- PARAMÈTRES DE REQUÊTE ---
+
+def parent_zone(value):
+    """Zone parente facultative (?parent_id=, 'null' / 'undefined' du frontend = aucune) ; ValueError si invalide"""
+    if not value or value in ('null', 'undefined'):
+        return None
+    return queries.parse_int('parent_id', value)
+
+
+def geometry_lod(zoom, tolerance):
+    """(lod, décimales) demandés via ?zoom= ou ?tolerance= (géométrie complète par défaut) ; ValueError si invalide"""
+    return pick_geometry_lod(
+        zoom=queries.parse_number('zoom', zoom) if zoom else None,
+        tolerance=queries.parse_number('tolerance', tolerance) if tolerance else None
+    )
+
+
+def viewport(bbox, clip):
+    """(bbox, clip) demandés via ?bbox=minLon,minLat,maxLon,maxLat et ?clip=1 ; ValueError si bbox invalide"""
+    return (queries.parse_bbox(bbox) if bbox else None), clip in ('1', 'true')
+
+
+def tile_level(layer, z, x, y):
+    """Niveau de zones d'une tuile /api/tiles/<layer>/<z>/<x>/<y>.pbf, None si la tuile n'existe pas"""
+    level = layer.upper()
+    if level not in ZONE_LEVELS or z > 22 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return None
+    return level
+
+
+def tile_sector(value):
+    """Filière d'une tuile (?sector_id=), ignorée si elle n'est pas un entier"""
+    return int(value) if value and value.isdigit() else None
+
+
+def panel_params(sector_id, year):
+    """Filtres facultatifs des sections du panneau (?sector_id=, ?year=) ; ValueError si invalides"""
+    return {
+        "sub_sector_id": queries.parse_int('sector_id', sector_id) if sector_id else None,
+        "year": queries.parse_int('year', year) if year else None,
+    }
+
+
+def panel_sections(value):
+    """Sections demandées au panneau (?sections=, toutes par défaut) ; ValueError si inconnues"""
+    sections = [s.strip() for s in (value or ','.join(queries.PANEL_SECTIONS)).split(',') if s.strip()]
+    unknown = [s for s in sections if s not in queries.PANEL_SECTIONS]
+    if unknown:
+        raise ValueError(f"Sections inconnues : {', '.join(unknown)}")
+    return sections
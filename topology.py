@@ -0,0 +1,142 @@
+"""Encodage TopoJSON des contours de zones.
+
+Les frontières communes à deux zones voisines ne sont stockées qu'une fois (arcs
+dédoublonnés), les coordonnées sont quantifiées sur une grille entière et les arcs
+encodés en deltas, comme le fait la bibliothèque topojson côté client.
+"""
+
+DEFAULT_QUANTIZATION = 100000
+
+
+def _bbox(features):
+    xs, ys = [], []
+    for feature in features:
+        for polygon in _polygons(feature["geometry"]):
+            for ring in polygon:
+                for x, y in (p[:2] for p in ring):
+                    xs.append(x)
+                    ys.append(y)
+    if not xs:
+        return [0, 0, 0, 0]
+    return [min(xs), min(ys), max(xs), max(ys)]
+
+
+def _polygons(geometry):
+    if not geometry:
+        return []
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+
+def _quantize_ring(ring, x0, y0, kx, ky):
+    """Anneau quantifié, sans points consécutifs identiques ni point de fermeture"""
+    points = []
+    for coords in ring:
+        point = (int(round((coords[0] - x0) / kx)), int(round((coords[1] - y0) / ky)))
+        if not points or points[-1] != point:
+            points.append(point)
+    if len(points) > 1 and points[0] == points[-1]:
+        points.pop()
+    return points if len(points) >= 3 else None
+
+
+def _find_junctions(rings):
+    """Points où deux anneaux cessent de partager le même tracé"""
+    neighbours = {}
+    junctions = set()
+    for ring in rings:
+        n = len(ring)
+        for i, point in enumerate(ring):
+            pair = (ring[i - 1], ring[(i + 1) % n])
+            seen = neighbours.get(point)
+            if seen is None:
+                neighbours[point] = pair
+            elif seen != pair and seen != pair[::-1]:
+                junctions.add(point)
+    return junctions
+
+
+def _rotate_to_min(ring):
+    start = ring.index(min(ring))
+    return ring[start:] + ring[:start]
+
+
+def _cut_ring(ring, junctions):
+    """Découpe un anneau en arcs (chaque arc inclut ses deux extrémités)"""
+    cuts = [i for i, point in enumerate(ring) if point in junctions]
+    if not cuts:
+        # Anneau sans jonction : on le fait partir de son plus petit point, pour que le même
+        # anneau parcouru en sens inverse par une zone voisine donne exactement l'arc inversé
+        closed = _rotate_to_min(ring)
+        return [tuple(closed + closed[:1])]
+    ring = ring[cuts[0]:] + ring[:cuts[0]]
+    offsets = [i - cuts[0] for i in cuts]
+    arcs = []
+    for a, b in zip(offsets, offsets[1:] + [len(ring)]):
+        arcs.append(tuple(ring[a:b] + [ring[b % len(ring)]]))
+    return arcs
+
+
+def _encode_arc(arc):
+    encoded = [list(arc[0])]
+    for (x1, y1), (x2, y2) in zip(arc, arc[1:]):
+        encoded.append([x2 - x1, y2 - y1])
+    return encoded
+
+
+def build_topology(features, object_name="zones", quantization=DEFAULT_QUANTIZATION):
+    """Construit une Topology TopoJSON à partir de features GeoJSON (Polygon/MultiPolygon).
+
+    Chaque feature est un dict {"id", "properties", "geometry"}.
+    """
+    x0, y0, x1, y1 = _bbox(features)
+    kx = (x1 - x0) / (quantization - 1) if x1 > x0 else 1
+    ky = (y1 - y0) / (quantization - 1) if y1 > y0 else 1
+
+    # 1. Quantification de tous les anneaux
+    quantized = []
+    for feature in features:
+        polygons = []
+        for polygon in _polygons(feature["geometry"]):
+            rings = [_quantize_ring(ring, x0, y0, kx, ky) for ring in polygon]
+            if rings and rings[0] is not None:
+                polygons.append([r for r in rings if r is not None])
+        quantized.append(polygons)
+
+    junctions = _find_junctions(ring for polygons in quantized for polygon in polygons for ring in polygon)
+
+    # 2. Découpage en arcs et dédoublonnage (un arc partagé est référencé ~i dans l'autre sens)
+    arc_index = {}
+    arcs = []
+
+    def arc_ref(arc):
+        if arc in arc_index:
+            return arc_index[arc]
+        reverse = arc[::-1]
+        if reverse in arc_index:
+            return ~arc_index[reverse]
+        arc_index[arc] = len(arcs)
+        arcs.append(arc)
+        return arc_index[arc]
+
+    geometries = []
+    for feature, polygons in zip(features, quantized):
+        geometry = {
+            "type": "MultiPolygon",
+            "arcs": [[[arc_ref(arc) for arc in _cut_ring(ring, junctions)] for ring in polygon] for polygon in polygons],
+            "properties": feature.get("properties", {}),
+        }
+        if feature.get("id") is not None:
+            geometry["id"] = feature["id"]
+        geometries.append(geometry)
+
+    return {
+        "type": "Topology",
+        "bbox": [x0, y0, x1, y1],
+        "transform": {"scale": [kx, ky], "translate": [x0, y0]},
+        "objects": {object_name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [_encode_arc(arc) for arc in arcs],
+    }